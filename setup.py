@@ -7,6 +7,7 @@ extras_require = dict(test=['manuel', 'mock', 'zope.testing'])
 entry_points = """
 [console_scripts]
 rs-json-updater = j1m.relstoragejsonsearch.updater:main
+rs-json-benchmark = j1m.relstoragejsonsearch.benchmark:main
 """
 
 from setuptools import setup
@@ -1,3 +1,7 @@
+import time
+
+from . import tracing
+
 
 template = """
 with recursive
@@ -5,13 +9,13 @@ with recursive
    allowed({docid}, id, parent_id, allowed {extrav}) as (
        select {docid}, {docid} as id,
               {get_parent_id}({state}),
-              {check_access}({state}, array{principals}, '{permission}')
+              {check_access}({state}, {principals}, {permission})
               {extrav}
        from search_results
     union all
        select allowed.{docid}, {docs}.{docid} as id,
               {get_parent_id}({docs}.{state}),
-              {check_access}({docs}.{state}, array{principals}, '{permission}')
+              {check_access}({docs}.{state}, {principals}, {permission})
               {extra}
        from allowed, {docs}
        where allowed.allowed is null and
@@ -24,8 +28,27 @@ def filteredsearch(
     search, permission, principals, extra='',
     docid='docid', docs='docs', state='state', get_parent_id='get_parent_id',
     check_access='check_access', parent_expr=None, cursor=None,
+    args=None,
     ):
-    principals = repr(list(principals)).replace(',)', ')')
+    """Return, or execute, a search filtered by access
+
+    If permission and principals are None, the query has
+    ``permission`` and ``principals`` parameters, in the psycopg2
+    named-parameter style, rather than literal values, so it can be
+    prepared once, using search.Statement, and executed for any
+    principals.  Parameters of the search query must be named too.
+    If a cursor is given, an args mapping with values for the
+    parameters must be given too.
+    """
+    if permission is None and principals is None:
+        if cursor is not None and args is None:
+            raise ValueError("args are needed to execute a query with"
+                             " permission and principals parameters")
+        permission = '%(permission)s::varchar'
+        principals = '%(principals)s::varchar[]'
+    else:
+        permission = "'%s'" % permission
+        principals = 'array' + repr(list(principals)).replace(',)', ')')
     if extra:
         extrav = ',' + extra
         extra = extrav.replace(',', ',allowed.')
@@ -49,10 +72,14 @@ def filteredsearch(
     if cursor is None:
         return sql
     else:
+        start = time.time()
         try:
-            cursor.execute(sql)
+            cursor.execute(sql, args)
         except Exception:
             print(sql)
             raise
 
-        return cursor.fetchall()
+        result = cursor.fetchall()
+        tracing.record('filteredsearch', cursor.connection.cursor, sql, args,
+                       time.time() - start, len(result), 0)
+        return result
@@ -0,0 +1,147 @@
+"""Parallel, resumable initial population of object_json
+
+Rather than reading object_state in tid order, a backfill splits
+object_state into zoid ranges and converts them using several
+connections at once. Progress is recorded for each range, so an
+interrupted backfill picks up where it left off.
+
+Only records written at or before a snapshot tid, chosen when the
+backfill starts, are converted. When all of the ranges are done, the
+snapshot tid is stored in object_json_tid and the updater follows
+changes from there.
+"""
+import logging
+import psycopg2
+import Queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+setup_sql = """
+create table object_json_backfill (
+  lo bigint primary key, -- exclusive
+  hi bigint not null,    -- inclusive
+  done bigint not null,  -- zoids in (lo, done] have been converted
+  snapshot_tid bigint not null)
+"""
+
+range_sql = """
+select s.tid, s.zoid, s.state, j.pickle_hash
+from object_state s left join object_json j using (zoid)
+where s.zoid > %s and s.zoid <= %s and s.tid <= %s
+order by s.zoid
+limit %s
+"""
+
+def pending(cursor):
+    """Return whether there's a backfill in progress
+    """
+    cursor.execute("select from information_schema.tables"
+                   " where table_schema = 'public'"
+                   " AND table_name = 'object_json_backfill'")
+    return bool(list(cursor))
+
+def setup(cursor, nranges):
+    """Record the snapshot tid and the zoid ranges to be converted
+    """
+    ex = cursor.execute
+    ex(setup_sql)
+    ex("select max(tid), min(zoid), max(zoid) from object_state")
+    [[snapshot_tid, min_zoid, max_zoid]] = cursor.fetchall()
+    if snapshot_tid is not None:
+        lo = min_zoid - 1
+        step = max((max_zoid - lo + nranges - 1) // nranges, 1)
+        while lo < max_zoid:
+            hi = min(lo + step, max_zoid)
+            ex("insert into object_json_backfill values (%s, %s, %s, %s)",
+               (lo, hi, lo, snapshot_tid))
+            lo = hi
+    cursor.connection.commit()
+
+def convert_range(conn, writer, convert, lo, hi, done, snapshot_tid):
+    cursor = conn.cursor()
+    ex = cursor.execute
+    chunk_size = convert.chunk_size
+    while done < hi:
+        ex(range_sql, (done, hi, snapshot_tid, chunk_size))
+        data = cursor.fetchall()
+        if len(data) < chunk_size:
+            done = hi
+        else:
+            done = data[-1][1]
+        data = [j for j in convert(data) if j]
+        if data:
+            writer.write(data)
+            # object_json_tid isn't advanced until the backfill is
+            # done, so invalidate cached searches.
+            ex("update object_json_tid set generation = generation + 1")
+        ex("update object_json_backfill set done = %s where lo = %s",
+           (done, lo))
+        conn.commit()
+
+def backfill(url, convert, concurrency, cursor, ranges_per_worker=4):
+    """Convert object_state records in zoid ranges
+
+    Conversions are written using `concurrency` connections. If
+    there isn't a backfill in progress, one is started.
+
+    The snapshot tid is returned, after being saved in object_json_tid.
+    """
+    from .updater import Writer
+
+    if not pending(cursor):
+        setup(cursor, concurrency * ranges_per_worker)
+
+    ex = cursor.execute
+    ex("select lo, hi, done, snapshot_tid from object_json_backfill"
+       " where done < hi order by lo")
+    ranges = Queue.Queue()
+    for r in cursor.fetchall():
+        ranges.put(r)
+    cursor.connection.commit()
+    logger.info("Backfilling %s zoid ranges", ranges.qsize())
+
+    errors = []
+
+    def work():
+        conn = psycopg2.connect(url)
+        try:
+            writer = Writer(conn.cursor(), convert.metrics)
+            while not errors:
+                try:
+                    lo, hi, done, snapshot_tid = ranges.get(False)
+                except Queue.Empty:
+                    break
+                convert_range(conn, writer, convert,
+                              lo, hi, done, snapshot_tid)
+                logger.debug("Backfilled zoids %s through %s", lo + 1, hi)
+        except Exception as err:
+            logger.exception("Backfill failed")
+            errors.append(err)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=work, name='backfill-%s' % i)
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    ex("select snapshot_tid from object_json_backfill limit 1")
+    snapshot_tid = [r[0] for r in cursor.fetchall()]
+    if snapshot_tid:
+        [snapshot_tid] = snapshot_tid
+        ex("update object_json_tid set tid = %s", (snapshot_tid,))
+    else:
+        # object_state was empty
+        ex("select tid from object_json_tid")
+        [[snapshot_tid]] = cursor.fetchall()
+    ex("drop table object_json_backfill")
+    cursor.connection.commit()
+    logger.info("Backfilled through %s", snapshot_tid)
+    return snapshot_tid
@@ -0,0 +1,302 @@
+"""Benchmark record conversion
+
+A reproducible corpus of ZODB records is generated in several
+categories, and the rates at which they're converted by XUnpickler,
+jsonpickle.record and updater.jsonify are reported.
+
+The growth of peak memory use (ru_maxrss) while converting each
+category's records is also reported, measured in a forked process.
+
+Results can be saved as a baseline and later runs compared against
+it.  If any rate falls below the baseline by more than a tolerance,
+the regressions are reported and the exit status is 1.  Baselines are
+only meaningful on the machine they were recorded on, so none is
+provided.  To make one, run the benchmark on an otherwise idle
+machine, with a minimum time long enough for stable rates::
+
+  rs-json-benchmark -t 5 --save-baseline baseline.json
+
+and compare later runs on the same machine with ``-b baseline.json``.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import resource
+import sys
+import time
+import zlib
+
+import BTrees.OOBTree
+import persistent
+import ZODB
+from ZODB.utils import u64
+
+from . import jsonpickle
+from . import updater
+from . import xpickle
+
+class Content(persistent.Persistent):
+    pass
+
+class _CachedData(persistent.Persistent):
+    """Like the Karl class that holds compressed extracted file text
+    """
+
+class Folder(persistent.Persistent):
+    pass
+
+class Event(persistent.Persistent):
+    pass
+
+class Node(persistent.Persistent):
+    pass
+
+def make_words(rng, n=2000):
+    letters = u'abcdefghijklmnopqrstuvwxyz\xe9\xfc'
+    return [u''.join(rng.choice(letters) for i in range(rng.randint(2, 10)))
+            for j in range(n)]
+
+def text(rng, words, n):
+    return u' '.join(rng.choice(words) for i in range(n))
+
+def when(rng):
+    return datetime.datetime(2010, 1, 1) + datetime.timedelta(
+        seconds=rng.randint(0, 200000000))
+
+def content(rng, words, others):
+    ob = Content()
+    ob.title = text(rng, words, 8)
+    ob.description = text(rng, words, 40)
+    ob.text = text(rng, words, rng.randint(200, 2000))
+    ob.creator = 'user%s' % rng.randint(0, 999)
+    ob.created = when(rng)
+    ob.modified = when(rng)
+    ob.tags = [text(rng, words, 1) for i in range(rng.randint(0, 8))]
+    ob.related = rng.sample(others, min(len(others), 3))
+    return ob
+
+def cached_data(rng, words, others):
+    ob = _CachedData()
+    ob.encoding = 'utf-8'
+    ob.data = zlib.compress(
+        text(rng, words, rng.randint(500, 5000)).encode('utf-8'))
+    return ob
+
+def shared(rng, words, others):
+    ob = Node()
+    ob.items = items = [dict(name=text(rng, words, 2), n=i)
+                        for i in range(rng.randint(5, 50))]
+    ob.by_name = dict((item['name'], item) for item in items)
+    ob.graph = graph = dict(name=text(rng, words, 1), children=[])
+    graph['children'].append(dict(parent=graph, children=[]))
+    return ob
+
+def dates(rng, words, others):
+    ob = Event()
+    ob.start = when(rng)
+    ob.end = when(rng)
+    ob.occurrences = [when(rng) for i in range(rng.randint(10, 100))]
+    ob.days = [when(rng).date() for i in range(10)]
+    return ob
+
+def references(rng, words, others):
+    ob = Folder()
+    ob.title = text(rng, words, 3)
+    ob.items = dict((text(rng, words, 1), other)
+                    for other in rng.sample(others, min(len(others), 100)))
+    return ob
+
+factories = (
+    ('content', content),
+    ('cached_data', cached_data),
+    ('shared_cyclic', shared),
+    ('datetimes', dates),
+    ('references', references),
+    )
+
+def corpus(n=100, seed=0):
+    """Generate records by category
+
+    A dictionary mapping category names to lists of (tid, zoid, pickle,
+    pickle_hash) records is returned.
+    """
+    rng = random.Random(seed)
+    words = make_words(rng)
+    db = ZODB.DB(None)
+    conn = db.open()
+    others = [Content() for i in range(100)]
+    for ob in others:
+        conn.add(ob)
+
+    obs = {}
+    for name, factory in factories:
+        obs[name] = [factory(rng, words, others) for i in range(n)]
+        for ob in obs[name]:
+            conn.add(ob)
+
+    tree = BTrees.OOBTree.OOBTree()
+    conn.add(tree)
+    while len(tree) < n * 30:
+        tree[text(rng, words, 2)] = rng.choice(others)
+    conn.transaction_manager.commit()
+
+    buckets = []
+    bucket = tree._firstbucket
+    while bucket is not None:
+        buckets.append(bucket)
+        bucket = bucket._next
+    obs['btree_buckets'] = buckets[:n]
+
+    result = {}
+    for name, obs in sorted(obs.items()):
+        records = result[name] = []
+        for ob in obs:
+            p, serial = db.storage.load(ob._p_oid)
+            records.append((u64(serial), u64(ob._p_oid), p, None))
+    db.close()
+    return result
+
+class RawInstance(object):
+
+    def __init__(self, global_, args):
+        self.global_ = global_
+        self.args = args
+
+    def __setstate__(self, state):
+        self.state = state
+
+class RawUnpickler(xpickle.XUnpickler):
+    """Unpickler with trivial hooks, to measure opcode handling
+    """
+
+    _x_Put = _x_Get = lambda self, id, v: v
+    _x_Persistent = lambda self, id: id
+    _x_Global = lambda self, module, name: (module, name)
+    _x_Instance = RawInstance
+    _x_load = lambda self, v: v
+
+def xunpickle(record):
+    unpickler = RawUnpickler(record[2])
+    unpickler.load()
+    unpickler.load()
+
+def jsonpickle_record(record):
+    jsonpickle.record(record[2])
+
+def jsonify(record):
+    updater.jsonify(record, updater.default_transformation)
+
+functions = (
+    ('xpickle', xunpickle),
+    ('record', jsonpickle_record),
+    ('jsonify', jsonify),
+    )
+
+def rate(func, records, min_time):
+    """Return the number of records converted per second
+    """
+    count = 0
+    start = time.time()
+    while True:
+        for record in records:
+            func(record)
+        count += len(records)
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+def maxrss_kib():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024 # bytes
+    return maxrss
+
+def peak_kib(func, records):
+    """Return the growth of peak memory use, in KiB, converting records
+
+    Records are converted in a forked process, so memory used by
+    earlier measurements doesn't hide the memory used by later ones,
+    although small allocations may reuse memory already resident.
+    None is returned if fork isn't available or conversion fails.
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read)
+            start = maxrss_kib()
+            for record in records:
+                func(record)
+            os.write(write, str(maxrss_kib() - start))
+        finally:
+            os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return float(result) if result else None
+
+def run(records, min_time=1.0):
+    results = {}
+    for category, category_records in sorted(records.items()):
+        for name, func in functions:
+            results['%s.%s' % (category, name)] = dict(
+                rate=rate(func, category_records, min_time),
+                peak_kib=peak_kib(func, category_records),
+                )
+    return results
+
+def regressions(results, baseline, tolerance):
+    """Return (name, rate, baseline_rate) for rates below baseline
+    """
+    return [(name, results[name]['rate'], baseline[name]['rate'])
+            for name in sorted(results)
+            if name in baseline and
+            results[name]['rate'] < baseline[name]['rate'] * (1 - tolerance)]
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('-n', '--records', type=int, default=100,
+                    help='Number of records per category')
+parser.add_argument('-s', '--seed', type=int, default=0,
+                    help='Random seed used to generate the corpus')
+parser.add_argument('-t', '--min-time', type=float, default=1.0,
+                    help='Minimum time, in seconds, to time each function')
+parser.add_argument('-b', '--baseline',
+                    help='Baseline file to compare results against')
+parser.add_argument('--tolerance', type=float, default=.25,
+                    help='Fraction of a baseline rate that a rate may fall'
+                    ' below without being reported as a regression')
+parser.add_argument('--save-baseline',
+                    help='Save results as a baseline in the given file')
+
+def main(args=None):
+    options = parser.parse_args(args)
+    results = run(corpus(options.records, options.seed), options.min_time)
+
+    print('%-32s %12s %12s' % ('', 'records/s', 'peak KiB'))
+    for name, result in sorted(results.items()):
+        peak = result['peak_kib']
+        print('%-32s %12.0f %12s' % (
+            name, result['rate'], '-' if peak is None else '%.1f' % peak))
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True,
+                      separators=(',', ': '))
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressed = regressions(results, baseline, options.tolerance)
+        for name, rate, baseline_rate in regressed:
+            print('REGRESSION %s: %.0f records/s, baseline %.0f' % (
+                name, rate, baseline_rate))
+        if regressed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Remove object_json records for objects that no longer exist
+
+The updater only sees inserts and updates, so when objects are removed
+from object_state by packing, their object_json records linger.
+Orphans are found and deleted a zoid range at a time, committing after
+each range, so locks are held only briefly.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+range_sql = """
+select max(zoid) from (
+  select zoid from object_json where zoid > %s order by zoid limit %s
+  ) _
+"""
+
+# Both tables are restricted to the same zoid range, so the anti-join
+# can be done by merging primary-key index scans.
+delete_sql = """
+delete from object_json
+where zoid in (
+  select j.zoid
+  from object_json j left join object_state s
+       on s.zoid = j.zoid and s.zoid > %(lo)s and s.zoid <= %(hi)s
+  where j.zoid > %(lo)s and j.zoid <= %(hi)s and s.zoid is null
+  )
+"""
+
+def collect(conn, batch_size=10000, pause=0):
+    """Delete object_json records whose objects aren't in object_state
+
+    Records are checked in batches of batch_size zoids, committing
+    after each batch.  An optional pause, in seconds, between batches
+    reduces the load on the database.
+
+    The number of records deleted is returned.
+    """
+    cursor = conn.cursor()
+    ex = cursor.execute
+    lo = -1
+    deleted = 0
+    while True:
+        ex(range_sql, (lo, batch_size))
+        [[hi]] = cursor.fetchall()
+        if hi is None:
+            conn.commit()
+            break
+        ex(delete_sql, dict(lo=lo, hi=hi))
+        if cursor.rowcount:
+            deleted += cursor.rowcount
+            # Invalidate cached searches.
+            ex("update object_json_tid set generation = generation + 1")
+        conn.commit()
+        lo = hi
+        if pause:
+            time.sleep(pause)
+
+    logger.info("Deleted %s orphaned object_json records", deleted)
+    return deleted
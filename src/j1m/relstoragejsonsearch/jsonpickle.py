@@ -1,8 +1,11 @@
 import binascii
 import json
 import datetime
+import hashlib
+from json.encoder import encode_basestring_ascii
+import re
 from struct import unpack
-from cStringIO import StringIO
+from zodbpickle import fastpickle
 
 from . import xpickle
 
@@ -76,6 +79,17 @@ class Bytes(object):
     def json_reduce(self):
         return {'::': 'hex', 'hex': binascii.b2a_hex(self.data)}
 
+def bytes_descriptor(data):
+    """Describe binary data too large to include in JSON
+    """
+    return {'::': 'bytes', 'length': len(data),
+            'md5': hashlib.md5(data).hexdigest()}
+
+class LargeBytes(Bytes):
+
+    def json_reduce(self):
+        return bytes_descriptor(self.data)
+
 class Get(object):
 
     def __init__(self, unpickler, id, v):
@@ -140,11 +154,25 @@ def default(ob):
     return ob.json_reduce()
 
 class JsonUnpickler(xpickle.XUnpickler):
+    """Convert pickles to JSON text
+
+    Non-ascii strings are represented as hex.  If binary_limit is
+    given, non-ascii strings longer than binary_limit bytes are
+    represented by their lengths and MD5 digests instead.
+
+    If attributes is set to a collection of names, only those items of
+    top-level state dictionaries are converted.
+    """
 
     _x_Persistent = Persistent
     _x_Global = Global
     _x_Instance = Instance
     _x_cyclic = False
+    attributes = None
+
+    def __init__(self, data, binary_limit=None):
+        xpickle.XUnpickler.__init__(self, data)
+        self.binary_limit = binary_limit
 
     def _x_Put(self, id, v):
         if isinstance(v, basic_types):
@@ -152,17 +180,22 @@ class JsonUnpickler(xpickle.XUnpickler):
         else:
             return Put(self, id, v)
 
+    _x_got = False # Whether memoized containers were referenced
+
     def _x_Get(self, id, v):
         if isinstance(v, basic_types):
             return v
         else:
-            v.got = True
+            v.got = self._x_got = True
             return Get(self, id, v.v)
 
     def _x_String(self, v):
         try:
             v.decode('ascii')
         except UnicodeDecodeError:
+            limit = self.binary_limit
+            if limit is not None and len(v) > limit:
+                return LargeBytes(v)
             return Bytes(v)
         else:
             return v
@@ -177,17 +210,300 @@ class JsonUnpickler(xpickle.XUnpickler):
         return Instance(global_, args)
 
     def _x_load(self, data):
-        try:
-            return json.dumps(data, default=default)
-        except ValueError:
-            # We probably have a cycle. Try again:
-            self._x_cyclic = True
-            return json.dumps(data, default=default)
+        if self.attributes is not None:
+            project(data, self.attributes)
+        # Data can only be cyclic if memoized containers were
+        # referenced, so we usually don't need to check.
+        if self._x_got and not self._x_cyclic:
+            self._x_cyclic = cyclic(data)
+        return json.dumps(data, default=default)
+
+def project(data, names):
+    """Remove the items of a top-level state dictionary that aren't named
+    """
+    if isinstance(data, Put):
+        data = data.v
+    if type(data) is dict:
+        for k in data.keys():
+            if k not in names:
+                del data[k]
+
+def cyclic(data):
+    """Return whether data loaded by JsonUnpickler has reference cycles
+    """
+    path = set()
+    done = set()
+
+    def visit(ob):
+        if isinstance(ob, Get): # or Put
+            ob = ob.v
+        if isinstance(ob, Instance):
+            children = ob.args, getattr(ob, 'state', None)
+        elif isinstance(ob, (list, tuple)):
+            children = ob
+        elif isinstance(ob, dict):
+            children = ob.values()
+        else:
+            return False
+
+        i = id(ob)
+        if i in path:
+            return True
+        if i in done:
+            return False
+        path.add(i)
+        for child in children:
+            if visit(child):
+                return True
+        path.remove(i)
+        done.add(i)
+        return False
+
+    return visit(data)
+
+
+class Unsupported(Exception):
+    """A pickle can't be converted by JsonEmitter
+
+    JsonUnpickler should be used instead.
+    """
+
+# Postgres rejects surrogates, so each surrogate code unit, including
+# those that would be needed to escape characters outside the basic
+# multilingual plane, is replaced with a space.
+surrogates = re.compile(u'[\ud800-\udfff]|([\U00010000-\U0010ffff])')
+escaped_surrogates = re.compile(r'\\ud[89a-f][0-9a-f]{2,2}', flags=re.I)
+
+def _replace_surrogate(match):
+    return u'  ' if match.group(1) else u' '
 
+class Class(Global):
+    """A global that creates instances when called
+
+    Instances created are added to the instances list, if given.
+    """
+
+    def __init__(self, module, name, instances=None):
+        Global.__init__(self, module, name)
+        self.instances = instances
+
+    def __call__(self, *args):
+        name = self.name
+        if name in special_classes:
+            return special_classes[name](name, args)
+        instance = InstanceState(self, args)
+        if self.instances is not None:
+            self.instances.append(instance)
+        return instance
+
+class InstanceState(dict):
+
+    def __init__(self, class_, args):
+        self['::'] = class_.name
+        if args:
+            self['__class_args__'] = args
+
+    def __setstate__(self, state):
+        self['state'] = state
+
+    def merge(self):
+        """Merge a dictionary state, like Instance.json_reduce
+
+        Instance only merges states that weren't memoized, as others
+        are wrapped by Put, so this should only be called for those.
+        """
+        state = self.pop('state')
+        own = dict(self)
+        self.update(state)
+        self.update(own)
+
+def persistent_load(pid):
+    if isinstance(pid, str):
+        id = u64(pid)
+    elif (isinstance(pid, tuple) and len(pid) == 2 and
+          isinstance(pid[0], str) and isinstance(pid[1], Global)):
+        id = [u64(pid[0]), pid[1].name]
+    else:
+        raise Unsupported("persistent id", pid)
+    return {'::': 'persistent', 'id': id}
+
+class JsonEmitter(object):
+    """Convert pickles to JSON text in a single encoding pass
+
+    Unlike JsonUnpickler, no wrapper objects are created for pickle
+    data.  Pickles are loaded into basic Python data by zodbpickle's C
+    unpickler (which supports protocol 3, unlike cPickle), with
+    instances represented as dictionaries, and encoded by the json
+    module's C encoder without per-object callbacks.  Output is the
+    same as for JsonUnpickler, except that surrogates are removed.
+
+    If a pickle has cycles, or data that can't be represented this
+    way, Unsupported is raised and JsonUnpickler should be used.
+
+    Binary data are represented as for JsonUnpickler, with the same
+    binary_limit.
+    """
+
+    def __init__(self, f, binary_limit=None):
+        self.binary_limit = binary_limit
+        self.unpickler = unpickler = fastpickle.Unpickler(f)
+        unpickler.find_global = self._find_global
+        unpickler.persistent_load = persistent_load
+        self.instances = []
+
+    def _find_global(self, module, name):
+        return Class(module, name, self.instances)
+
+    def _load(self):
+        try:
+            data = self.unpickler.load()
+        except (fastpickle.UnpicklingError, TypeError, ValueError) as err:
+            raise Unsupported(err)
+        if self.instances:
+            self._merge_states()
+        return data
+
+    def _merge_states(self):
+        # JsonUnpickler merges dictionary states into instances, unless
+        # the states were memoized.
+        memoized = set(id(v) for v in self.unpickler.memo.itervalues())
+        for instance in self.instances:
+            state = instance.get('state')
+            if type(state) is dict and id(state) not in memoized:
+                instance.merge()
+        del self.instances[:]
+
+    def skip(self):
+        """Read past a pickle without converting it
+        """
+        self._load()
+
+    def load(self, decode=None, attributes=None):
+        """Convert the next pickle
+
+        If attributes is given, only those items of a top-level state
+        dictionary are converted.
+
+        If a decode function is given, it's called with the loaded
+        data, and its result, which must be JSON serializable, is
+        converted instead.  This allows useful data to be extracted
+        from binary data before the binary data are dropped.
+        """
+        data = self._load()
+        if attributes is not None:
+            project(data, attributes)
+        if decode is not None:
+            data = decode(data)
+        try:
+            text = json.dumps(data, default=default, encoding='ascii',
+                              separators=(',', ':'))
+        except UnicodeDecodeError:
+            # Non-ascii strings are represented as hex, or described.
+            return encode(data, self.binary_limit)
+        except (ValueError, TypeError) as err:
+            # Most likely a cycle, or an unsupported dictionary key.
+            raise Unsupported(err)
+        if '\\ud' in text:
+            text = escaped_surrogates.sub(' ', text)
+        return text
+
+def encode(ob, binary_limit=None):
+    """Encode data loaded by JsonEmitter as JSON text
+    """
+    out = []
+    _encode(ob, out.append, set(), binary_limit)
+    return ''.join(out)
+
+def _encode(ob, write, open_, limit):
+    t = type(ob)
+    if t is unicode:
+        write(encode_basestring_ascii(surrogates.sub(_replace_surrogate, ob)))
+    elif isinstance(ob, str): # including zodbpickle.binary
+        try:
+            ob.decode('ascii')
+        except UnicodeDecodeError:
+            if limit is not None and len(ob) > limit:
+                write('{"::":"bytes","length":%s,"md5":"%s"}' % (
+                    len(ob), hashlib.md5(ob).hexdigest()))
+            else:
+                write('{"::":"hex","hex":"%s"}' % binascii.b2a_hex(ob))
+        else:
+            write(encode_basestring_ascii(ob))
+    elif ob is None or t is bool or t is int or t is long or t is float:
+        write(json.dumps(ob))
+    elif isinstance(ob, Global):
+        write(json.dumps(ob.json_reduce()))
+    elif t is list or t is tuple or isinstance(ob, dict):
+        i = id(ob)
+        if i in open_:
+            raise Unsupported("cycle")
+        open_.add(i)
+        if isinstance(ob, dict):
+            write('{')
+            first = True
+            for k, v in ob.iteritems():
+                if first:
+                    first = False
+                else:
+                    write(',')
+                if not isinstance(k, basestring):
+                    if k is None or isinstance(k, (int, long, float)):
+                        k = json.dumps(k)
+                    else:
+                        raise Unsupported("key", k)
+                _encode(k.decode('ascii') if isinstance(k, str) else k,
+                        write, open_, limit)
+                write(':')
+                _encode(v, write, open_, limit)
+            write('}')
+        else:
+            write('[')
+            first = True
+            for v in ob:
+                if first:
+                    first = False
+                else:
+                    write(',')
+                _encode(v, write, open_, limit)
+            write(']')
+        open_.remove(i)
+    else:
+        raise Unsupported(ob)
+
+PROTO, MARK, GLOBAL = '\x80(c'
+
+def class_name(p, head_size=256):
+    """Get the class name from a database record without unpickling
+
+    Class pickles normally start with a GLOBAL opcode for the class,
+    possibly preceded by a PROTO opcode and, if there are class
+    arguments, a MARK.  None is returned if the pickle doesn't start
+    this way.
+
+    The record may be a string, a buffer or a memoryview.  Only the
+    start of it is copied.
+    """
+    head = p[:head_size]
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    i = 0
+    if head[:1] == PROTO:
+        i = 2
+    if head[i:i+1] == MARK:
+        i += 1
+    if head[i:i+1] != GLOBAL:
+        return None
+    i += 1
+    module_end = head.find('\n', i)
+    name_end = head.find('\n', module_end + 1)
+    if module_end < 0 or name_end < 0:
+        if len(head) == head_size:
+            return class_name(p, head_size * 16)
+        return None
+    return head[i:module_end] + '.' + head[module_end+1:name_end]
 
 def record(pickle):
-    f = StringIO(pickle)
-    unpickler = JsonUnpickler(f)
+    unpickler = JsonUnpickler(pickle)
     part1 = unpickler.load()
-    l1 = f.tell()
+    l1 = unpickler.tell()
     return part1, l1, unpickler.load()
@@ -0,0 +1,250 @@
+"""Updater metrics
+
+Metrics are kept in process and can be exposed as Prometheus-style
+text, either over HTTP or by periodically writing a stats file.
+"""
+import BaseHTTPServer
+import bisect
+import heapq
+import logging
+import os
+import psycopg2
+import threading
+from ZODB.TimeStamp import TimeStamp
+from ZODB.utils import p64
+
+logger = logging.getLogger(__name__)
+
+prefix = 'rs_json_updater_'
+
+# Conversion-time histogram buckets, in seconds
+buckets = (.0001, .0003, .001, .003, .01, .03, .1, .3, 1, 3)
+
+counter_help = dict(
+    records_read='Records read from object_state',
+    records_converted='Records converted to JSON',
+    records_unchanged='Records skipped because their pickles were unchanged',
+    records_skipped='Records skipped because of their classes',
+    records_cyclic='Records converted with references because of cycles',
+    records_undecoded='Records converted without their decoders',
+    records_written='Records written to object_json',
+    records_failed='Records that could not be written to object_json',
+    merge_failures='Chunk merges that failed, causing chunks to be split',
+    commits='Updater transactions committed',
+    )
+
+def tid_time(tid):
+    return TimeStamp(p64(tid)).timeTime()
+
+def escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"')
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, v):
+        self.counts[bisect.bisect_left(buckets, v)] += 1
+        self.sum += v
+
+class Metrics:
+    """Updater metrics
+
+    Methods are thread safe, as records may be converted and written
+    in multiple threads.
+    """
+
+    pipeline = None
+    object_state_tid = object_json_tid = None
+
+    def __init__(self, top=20, max_failed=100):
+        self.lock = threading.Lock()
+        self.counters = dict((name, 0) for name in counter_help)
+        self.histograms = {}
+        self.top = top
+        self.slowest = [] # heap of (seconds, zoid, class_name)
+        self.max_failed = max_failed
+        self.failed = [] # recently failed zoids
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def note_conversion(self, status, class_name, zoid, seconds):
+        """Record the outcome of a conversion
+
+        The status is one of 'converted', 'unchanged' or 'skipped'.
+        Records with cycles are also noted with the status 'cyclic',
+        and records that couldn't be decoded with 'undecoded'.
+        """
+        with self.lock:
+            self.counters['records_' + status] += 1
+            if status != 'converted':
+                return
+            histogram = self.histograms.get(class_name)
+            if histogram is None:
+                histogram = self.histograms[class_name] = Histogram()
+            histogram.observe(seconds)
+            item = seconds, zoid, class_name
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def note_failure(self, zoid):
+        with self.lock:
+            self.counters['records_failed'] += 1
+            self.failed.append(zoid)
+            del self.failed[:-self.max_failed]
+
+    def update_lag(self, cursor):
+        """Update the object_state and object_json tids
+        """
+        cursor.execute("select max(tid) from object_state")
+        [[self.object_state_tid]] = cursor.fetchall()
+        cursor.execute("select tid from object_json_tid")
+        [[self.object_json_tid]] = cursor.fetchall()
+        cursor.connection.rollback()
+
+    def lag(self):
+        """Return the lag in seconds
+        """
+        state_tid, json_tid = self.object_state_tid, self.object_json_tid
+        if state_tid is None or json_tid is None or json_tid >= state_tid:
+            return 0.0
+        return tid_time(state_tid) - tid_time(max(json_tid, 0))
+
+    def slowest_conversions(self):
+        with self.lock:
+            return sorted(self.slowest, reverse=True)
+
+    def text(self):
+        """Return metrics in the Prometheus text exposition format
+        """
+        lines = []
+        add = lines.append
+
+        def metric(name, type_, help, values):
+            name = prefix + name
+            add('# HELP %s %s' % (name, help))
+            add('# TYPE %s %s' % (name, type_))
+            for labels, value in values:
+                labels = ','.join(
+                    '%s="%s"' % (k, escape(v)) for (k, v) in labels)
+                if labels:
+                    labels = '{%s}' % labels
+                add('%s%s %s' % (name, labels, value))
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = sorted(
+                (name, list(h.counts), h.sum)
+                for (name, h) in self.histograms.items())
+            failed = list(self.failed)
+
+        for name in sorted(counters):
+            metric(name + '_total', 'counter', counter_help[name],
+                   [((), counters[name])])
+
+        if self.object_state_tid is not None:
+            metric('object_state_tid', 'gauge', 'Last object_state tid',
+                   [((), self.object_state_tid)])
+            metric('object_json_tid', 'gauge', 'Last object_json tid',
+                   [((), self.object_json_tid)])
+            metric('lag_seconds', 'gauge',
+                   'Time between the last object_state and object_json tids',
+                   [((), '%.3f' % self.lag())])
+
+        if histograms:
+            name = prefix + 'conversion_seconds'
+            add('# HELP %s Conversion time by class' % name)
+            add('# TYPE %s histogram' % name)
+            for (class_name, counts, sum_) in histograms:
+                labels = '{class="%s"' % escape(class_name)
+                total = 0
+                for le, count in zip(buckets + ('+Inf',), counts):
+                    total += count
+                    add('%s_bucket%s,le="%s"} %s' % (name, labels, le, total))
+                add('%s_sum%s} %s' % (name, labels, sum_))
+                add('%s_count%s} %s' % (name, labels, total))
+
+        metric('slowest_conversion_seconds', 'gauge',
+               'Slowest conversions',
+               [((('zoid', zoid), ('class', class_name)), seconds)
+                for (seconds, zoid, class_name) in self.slowest_conversions()])
+
+        metric('failed_zoid', 'gauge', 'Recently failed zoids',
+               [((('zoid', zoid),), 1) for zoid in failed])
+
+        if self.pipeline is not None:
+            for qname, stats in sorted(self.pipeline.stats().items()):
+                for sname, value in sorted(stats.items()):
+                    metric('%s_queue_%s' % (qname, sname), 'gauge',
+                           'Pipeline %s queue %s' % (qname, sname),
+                           [((), value)])
+
+        return '\n'.join(lines) + '\n'
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        text = self.server.metrics.text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+def serve(metrics, port, host=''):
+    """Serve metrics over HTTP in a daemon thread
+
+    The server is returned.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), Handler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server')
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def write_stats_file(metrics, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(metrics.text())
+    os.rename(tmp, path)
+
+def monitor(metrics, url, interval, path=None):
+    """Update lag metrics, and optionally write a stats file, periodically
+
+    This is done in a daemon thread using a separate connection. An
+    event is returned that can be set to stop monitoring.
+    """
+    stop = threading.Event()
+
+    def run():
+        conn = psycopg2.connect(url)
+        try:
+            cursor = conn.cursor()
+            while True:
+                try:
+                    metrics.update_lag(cursor)
+                    if path:
+                        write_stats_file(metrics, path)
+                except Exception:
+                    logger.exception("Updating metrics")
+                    conn.rollback()
+                if stop.wait(interval):
+                    break
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=run, name='metrics-monitor')
+    thread.setDaemon(True)
+    thread.start()
+    return stop
@@ -0,0 +1,30 @@
+-- Notify the updater of object_state changes, once per statement,
+-- rather than once per row.  The payload is the last tid written and
+-- the number of rows written: '<tid> <count>'.
+
+drop trigger if exists trigger_notify_object_state_changed on object_state;
+drop trigger if exists trigger_notify_object_state_inserted on object_state;
+drop trigger if exists trigger_notify_object_state_updated on object_state;
+
+create or replace function notify_object_state_changed() returns trigger
+as $$
+declare
+  last_tid bigint;
+  changed bigint;
+begin
+  select max(tid), count(*) from changed_rows into last_tid, changed;
+  if changed > 0 then
+    perform pg_notify('object_state_changed', last_tid || ' ' || changed);
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+-- Triggers with transition tables can only have one event.
+create trigger trigger_notify_object_state_inserted
+  after insert on object_state referencing new table as changed_rows
+  for each statement execute procedure notify_object_state_changed();
+
+create trigger trigger_notify_object_state_updated
+  after update on object_state referencing new table as changed_rows
+  for each statement execute procedure notify_object_state_changed();
@@ -0,0 +1,103 @@
+"""Reconvert selected object_json records
+
+When a transformation changes in a way that only affects some classes,
+only the records for those classes need to be reconverted.  Records
+are selected using object_json.class_name (and optionally zoid
+ranges), and their current pickles are re-read from object_state.
+
+This can run alongside the live updater.  A reconverted record is only
+written if its object_state record hasn't changed since it was read,
+so newer data written by the updater isn't overwritten.
+"""
+import logging
+
+from .updater import Writer
+
+logger = logging.getLogger(__name__)
+
+select_sql = """
+select s.tid, s.zoid, s.state, null::bigint
+from object_json j join object_state s using (zoid)
+where %s
+"""
+
+# Only existing records are updated, and only if the object_state
+# record they were converted from is still current.
+guarded_merge_sql = """
+update object_json j
+set class_name   = st.class_name,
+    class_pickle = st.class_pickle,
+    state        = st.state::jsonb,
+    pickle_hash  = st.pickle_hash
+from object_json_staging st join object_state s
+     on s.zoid = st.zoid and s.tid = st.tid
+where j.zoid = st.zoid
+"""
+
+class RedoWriter(Writer):
+
+    merge_sql = guarded_merge_sql
+
+    def commit(self, tid):
+        # object_json_tid isn't advanced, so invalidate cached searches.
+        self.ex("update object_json_tid set generation = generation + 1")
+        Writer.commit(self, tid)
+
+def parse_zoids(spec):
+    """Parse a zoid or inclusive zoid range, like 42 or 100-199
+    """
+    lo, _, hi = spec.partition('-')
+    lo = int(lo)
+    return lo, int(hi) if hi else lo
+
+def where_clause(classes=(), zoids=()):
+    conditions = []
+    params = []
+    if classes:
+        # Anchored, like re.match, as for --skip-class and --include-class.
+        conditions.append(
+            "j.class_name ~ any(array(select '^(?:' || p || ')'"
+            " from unnest(%s::text[]) p))")
+        params.append(list(classes))
+    if zoids:
+        conditions.append(
+            '(%s)' % ' or '.join(["j.zoid between %s and %s"] * len(zoids)))
+        for lo, hi in zoids:
+            params.extend((lo, hi))
+    return ' and '.join(conditions) or 'true', params
+
+def redo(conn, reader_conn, convert, classes=(), zoids=()):
+    """Reconvert records whose class names match any of the given patterns
+
+    Class-name patterns are regular expressions, which must match at
+    the start of class names.  zoids is a sequence
+    of inclusive zoid ranges.  Records must satisfy both criteria, when
+    given.
+
+    Records are read in a single pass using a server-side cursor on
+    reader_conn and written using conn, committing after each chunk.
+    The number of records read is returned.
+    """
+    where, params = where_clause(classes, zoids)
+    writer = RedoWriter(conn.cursor(), convert.metrics)
+    cursor = reader_conn.cursor('redo')
+    cursor.itersize = chunk_size = convert.chunk_size
+    cursor.execute(select_sql % where, params)
+    count = 0
+    try:
+        while True:
+            data = cursor.fetchmany(chunk_size)
+            if not data:
+                break
+            count += len(data)
+            convert.metrics.incr('records_read', len(data))
+            data = [j for j in convert(data) if j]
+            if data:
+                writer.write(data)
+                writer.commit(None)
+    finally:
+        cursor.close()
+        reader_conn.rollback()
+
+    logger.info("Reconverted %s records", count)
+    return count
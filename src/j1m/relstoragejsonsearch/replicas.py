@@ -0,0 +1,247 @@
+"""Route searches to read replicas
+
+When a ReplicaRouter is installed, search queries are run on
+streaming-replica connections, rather than on RelStorage's load
+connection, moving heavy full-text and access-filtered queries off the
+primary.
+
+A replica is only used for a ZODB connection if the replica's
+object_json_tid is at or beyond the last transaction the ZODB
+connection has seen, so searches don't miss changes the connection
+can see.  If no replica is caught up, the router waits briefly and
+then falls back to the primary.
+
+Replicas may be ahead of a ZODB connection, so searches may find
+objects created after the connection's last transaction.  These are
+left out of results, which are otherwise as of the replica's snapshot.
+Prefetched states newer than the connection's last transaction aren't
+used.
+"""
+import logging
+import psycopg2
+import threading
+import time
+from ZODB.utils import u64
+
+logger = logging.getLogger(__name__)
+
+router = None
+
+def install(new):
+    """Install a router, or uninstall the current one, if None is passed
+
+    The previously installed router, if any, is returned.
+    """
+    global router
+    old = router
+    router = new
+    return old
+
+def cursor(conn, name=None):
+    """Return a cursor for searching using a ZODB connection
+    """
+    if router is not None:
+        return router.cursor(conn, name)
+    return conn._storage.ex_cursor(name)
+
+class ReplicaLag(Exception):
+    """No replica was caught up, and falling back was disabled
+    """
+
+class Replica:
+
+    tid = -1 # object_json_tid, when last checked
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.conn = psycopg2.connect(dsn)
+
+    def check(self):
+        """Update and return the replica's object_json_tid
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("select tid from object_json_tid")
+            [[self.tid]] = cursor.fetchall()
+        finally:
+            cursor.close()
+            self.conn.rollback()
+        return self.tid
+
+class ReplicaCursor(object):
+    """A replica cursor that returns its replica to the pool when closed
+
+    max_tid is the last transaction seen by the ZODB connection the
+    cursor is used for.
+    """
+
+    def __init__(self, router, replica, name, max_tid):
+        self.router = router
+        self.replica = replica
+        self.cursor = replica.conn.cursor(name)
+        self.max_tid = max_tid
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def itersize(self):
+        return self.cursor.itersize
+
+    @itersize.setter
+    def itersize(self, v):
+        self.cursor.itersize = v
+
+    def close(self):
+        replica, self.replica = self.replica, None
+        if replica is not None:
+            try:
+                self.cursor.close()
+                replica.conn.rollback()
+            except Exception:
+                logger.exception("Closing replica cursor")
+                replica.conn.close()
+            else:
+                self.router.release(replica)
+
+class ReplicaRouter:
+    """Route searches to replicas that have caught up
+
+    dsns are the connection strings of replicas, which are connected
+    to as needed and used in turn.  Replicas are checked one at a
+    time, idle connections first, and the first that has caught up is
+    used.  If none has, the router checks again every interval
+    seconds, for up to wait seconds, and then falls back to the
+    primary or, if fallback is false, raises ReplicaLag.
+
+    If connecting to a replica fails, it isn't tried again for backoff
+    seconds, doubling with each further failure, up to max_backoff
+    seconds.
+    """
+
+    def __init__(self, dsns, wait=.5, interval=.05, fallback=True,
+                 backoff=1, max_backoff=60):
+        self.dsns = list(dsns)
+        if not self.dsns:
+            raise ValueError("No replica DSNs")
+        self.wait = wait
+        self.interval = interval
+        self.fallback = fallback
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.idle = []
+        self.failures = {} # {dsn -> (failures, retry time)}
+        self.turn = 0
+        self.replica_searches = self.primary_searches = self.waits = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(replica=self.replica_searches,
+                        primary=self.primary_searches,
+                        waits=self.waits)
+
+    def release(self, replica):
+        with self.lock:
+            self.idle.append(replica)
+
+    def take_idle(self):
+        """Take the idle replicas, which must be released when done
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        return idle
+
+    def close(self):
+        """Close idle replica connections
+        """
+        for replica in self.take_idle():
+            replica.conn.close()
+
+    def _take_idle(self, dsn):
+        with self.lock:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i].dsn == dsn:
+                    return self.idle.pop(i)
+
+    def _connect(self, dsn):
+        """Connect to a replica, unless connecting is backing off
+        """
+        with self.lock:
+            failures, retry = self.failures.get(dsn, (0, 0))
+        if retry > time.time():
+            return None
+        try:
+            replica = Replica(dsn)
+        except psycopg2.Error:
+            logger.exception("Connecting to replica %r", dsn)
+            with self.lock:
+                self.failures[dsn] = failures + 1, time.time() + min(
+                    self.backoff * 2 ** failures, self.max_backoff)
+            return None
+        with self.lock:
+            self.failures.pop(dsn, None)
+        return replica
+
+    def _replicas(self):
+        """Generate replicas to check, idle connections first
+        """
+        with self.lock:
+            self.turn = (self.turn + 1) % len(self.dsns)
+        dsns = self.dsns[self.turn:] + self.dsns[:self.turn]
+        unconnected = []
+        for dsn in dsns:
+            replica = self._take_idle(dsn)
+            if replica is not None:
+                yield replica
+                if replica.conn.closed: # checking failed
+                    unconnected.append(dsn)
+            else:
+                unconnected.append(dsn)
+        for dsn in dsns:
+            if dsn in unconnected:
+                replica = self._connect(dsn)
+                if replica is not None:
+                    yield replica
+
+    def _check(self, replica, required):
+        """Return whether a replica has caught up
+        """
+        try:
+            # Replica tids only increase, so a replica that was
+            # caught up needn't be checked again.
+            return replica.tid >= required or replica.check() >= required
+        except psycopg2.Error:
+            logger.exception("Checking replica %r", replica.dsn)
+            replica.conn.close()
+            return False
+
+    def cursor(self, conn, name=None):
+        """Return a cursor on a caught-up replica, or on the primary
+        """
+        required = u64(conn._storage.lastTransaction())
+        deadline = time.time() + self.wait
+        while True:
+            checked = False
+            for replica in self._replicas():
+                checked = True
+                if self._check(replica, required):
+                    with self.lock:
+                        self.replica_searches += 1
+                    return ReplicaCursor(self, replica, name, required)
+                if not replica.conn.closed:
+                    self.release(replica)
+            if not checked or time.time() >= deadline:
+                break
+            with self.lock:
+                self.waits += 1
+            time.sleep(self.interval)
+
+        if not self.fallback:
+            raise ReplicaLag(required)
+        with self.lock:
+            self.primary_searches += 1
+        return conn._storage.ex_cursor(name)
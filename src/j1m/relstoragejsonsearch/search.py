@@ -3,12 +3,26 @@
 It's assumed that the API is used with an object stored in a
 RelStorage with a Postgres back end.
 """
+import base64
+import collections
 import contextlib
+import hashlib
+import itertools
+import json
+import marshal
+import re
 import relstorage.storage
+import threading
+import weakref
 import time
+from ZODB.blob import Blob
 import ZODB.Connection
+from ZODB.POSException import POSKeyError
 from ZODB.utils import p64
 
+from . import replicas
+from . import tracing
+
 # Monkey patches, ook
 def _ex_cursor(self, name=None):
     if self._stale_error is not None:
@@ -52,28 +66,149 @@ def _ex_get(self, oid, class_pickle):
 
 ZODB.Connection.Connection.ex_get = _ex_get
 
-def _result_iterator(conn, cursor, bufsize):
+def _ex_get_prefetched(self, oid, class_pickle, tid, state):
+    """Return the persistent object with oid 'oid'.
+
+    If the object is a ghost, it's activated using the given state
+    pickle, read with the search results, so it needn't be loaded.
+    """
+    obj = self.ex_get(oid, class_pickle)
+    if (state is not None and obj._p_changed is None and
+        not isinstance(obj, Blob)):
+        self._ex_prefetched = oid, bytes(state), p64(tid)
+        try:
+            obj._p_activate()
+        finally:
+            self._ex_prefetched = None
+    return obj
+
+ZODB.Connection.Connection._ex_prefetched = None
+ZODB.Connection.Connection.ex_get_prefetched = _ex_get_prefetched
+
+_setstate = ZODB.Connection.Connection.setstate
+
+def _ex_setstate(self, obj):
+    """Set an object's state, using a prefetched state if there is one
+    """
+    prefetched = self._ex_prefetched
+    if prefetched is None or prefetched[0] != obj._p_oid:
+        return _setstate(self, obj)
+
+    oid, p, serial = prefetched
+    self._reader.setGhostState(obj, p)
+    obj._p_serial = serial
+    self._cache.update_object_size_estimation(oid, len(p))
+    obj._p_estimated_size = len(p)
+
+ZODB.Connection.Connection.setstate = _ex_setstate
+
+# Result order is kept by numbering rows before joining.
+prefetch_sql = """
+select _.*, s.tid as prefetch_tid, s.state as prefetch_state
+from (select *, row_number() over () as prefetch_n from (%s) _) _
+     left join object_state s on s.zoid = _.zoid
+order by _.prefetch_n
+"""
+
+def prefetch_query(query):
+    """Return a query that also gets the states of a query's results
+
+    Search functions given such queries set the states of the objects
+    they return, rather than returning ghosts that are loaded one at a
+    time when used.
+    """
+    return prefetch_sql % query
+
+def _object_getter(conn, cursor):
+    """Return a function that gets objects for result rows, and whether
+    their states were prefetched
+    """
+    indexes = {d[0]: index for (index, d) in enumerate(cursor.description)}
+    zoid_index = indexes['zoid']
+    class_pickle_index = indexes['class_pickle']
+    if 'prefetch_state' in indexes:
+        tid_index = indexes['prefetch_tid']
+        state_index = indexes['prefetch_state']
+        get = conn.ex_get_prefetched
+        # Replicas may have states newer than the connection has seen.
+        max_tid = getattr(cursor, 'max_tid', None)
+        if max_tid is not None:
+            return (lambda r: get(p64(r[zoid_index]), r[class_pickle_index],
+                                  r[tid_index],
+                                  r[state_index] if r[tid_index] <= max_tid
+                                  else None)), True
+        return (lambda r: get(p64(r[zoid_index]), r[class_pickle_index],
+                              r[tid_index], r[state_index])), True
     get = conn.ex_get
+    return lambda r: get(p64(r[zoid_index]), r[class_pickle_index]), False
+
+hidden_sql = """
+select zoid from object_state where zoid = any(%s)
+group by zoid having max(tid) > %s
+"""
+
+def _hidden(conn, cursor, zoids):
+    """Return the zoids of objects the connection can't see
+
+    Replicas may be ahead of a ZODB connection, so searches on them
+    may find objects created after the connection's last transaction,
+    max_tid, which only replica cursors have.  Objects changed since
+    then are looked up in the connection's snapshot.
+    """
+    max_tid = getattr(cursor, 'max_tid', None)
+    if max_tid is None or not zoids:
+        return ()
+    hidden_cursor = cursor.connection.cursor()
+    try:
+        hidden_cursor.execute(hidden_sql, (list(zoids), max_tid))
+        changed = [zoid for (zoid,) in hidden_cursor.fetchall()]
+    finally:
+        hidden_cursor.close()
+    hidden = set()
+    for zoid in changed:
+        try:
+            conn._storage.load(p64(zoid))
+        except POSKeyError:
+            hidden.add(zoid)
+    return hidden
+
+def _visible(conn, cursor, rows, zoid_index=None):
+    """Return the result rows for objects the connection can see
+
+    Zoids are in the zoid column, unless zoid_index is given.
+    """
+    if getattr(cursor, 'max_tid', None) is None or not rows:
+        return rows
+    if zoid_index is None:
+        zoid_index = [d[0] for d in cursor.description].index('zoid')
+    hidden = _hidden(conn, cursor, [r[zoid_index] for r in rows])
+    if hidden:
+        rows = [r for r in rows if r[zoid_index] not in hidden]
+    return rows
+
+def _result_iterator(conn, cursor, bufsize, counts=None):
+    # counts[0] is incremented for each result, if counts is given.
+    if counts is None:
+        counts = [0]
     buf = []
     first = True
     it = iter(cursor)
     while True:
         if len(buf) < bufsize:
             fetch = []
-            for r in it:
-                if first:
-                    indexes = {d[0]: index
-                               for (index, d) in enumerate(cursor.description)}
-                    zoid_index = indexes['zoid']
-                    class_pickle_index = indexes['class_pickle']
-                    first = False
-                ob = get(p64(r[zoid_index]), r[class_pickle_index])
-                buf.append(ob)
-                fetch.append(ob)
-                if len(fetch) >= bufsize:
+            while not fetch:
+                rows = list(itertools.islice(it, bufsize))
+                if not rows:
                     break
+                rows = _visible(conn, cursor, rows)
+                if rows and first:
+                    get, prefetched = _object_getter(conn, cursor)
+                    first = False
+                fetch = [get(r) for r in rows]
+            counts[0] += len(fetch)
+            buf.extend(fetch)
 
-            if fetch:
+            if fetch and not prefetched:
                 conn.prefetch(fetch)
 
         if buf:
@@ -87,56 +222,643 @@ def _try_to_close_cursor(cursor):
     except Exception:
         pass
 
+def _trace(function, cursor, query, args, start, rows, objects):
+    # Called before the cursor is closed, so plans are captured on the
+    # connection the search ran on, which may be a replica's.
+    tracing.record(function, cursor.connection.cursor, query, args,
+                   time.time() - start, rows, objects)
+
 @contextlib.contextmanager
-def search_iterator(conn, query, args, bufsize=20):
-    cursor = conn._storage.ex_cursor(str(time.time()))
+def search_iterator(conn, query, args, bufsize=20, prefetch=False):
+    if prefetch:
+        query = prefetch_query(query)
+    start = time.time()
+    cursor = replicas.cursor(conn, str(time.time()))
     cursor.execute(query, args)
+    counts = [0]
     try:
-        yield _result_iterator(conn, cursor, bufsize)
-    except Exception:
+        yield _result_iterator(conn, cursor, bufsize, counts)
+        # The time includes the time taken to use the results.
+        _trace('search_iterator', cursor, query, args, start,
+               counts[0], counts[0])
+    finally:
         _try_to_close_cursor(cursor)
-        raise
+
+
+columns_sql = """
+select zoid, %s from (%s) _
+"""
+
+def _columns_query(query, columns):
+    """Return a query for columns and their names
+
+    columns is a sequence of (name, expression) pairs, or a
+    dictionary, whose expressions use the query's output columns.
+    """
+    if isinstance(columns, dict):
+        columns = sorted(columns.items())
+    names = [name for (name, expr) in columns]
+    return (columns_sql % (
+        ', '.join('%s as %s' % (expr, name) for (name, expr) in columns),
+        query),
+        names)
+
+def _columns(names, rows):
+    columns = dict((name, []) for name in names)
+    columns['zoid'] = []
+    names = ['zoid'] + names
+    for r in rows:
+        for name, v in zip(names, r):
+            columns[name].append(v)
+    return columns
+
+def search_columns(conn, query, args, columns):
+    """Return selected data for search results, without getting objects
+
+    The query must output zoids and any columns used by column
+    expressions, typically state.  For example, to get titles and
+    modification times::
+
+      search_columns(
+          conn, "select zoid, state from object_json where ...", args,
+          [('title', "state->>'title'"), ('modified', "state->'modified'")])
+
+    A dictionary mapping names to lists of values, in result order, is
+    returned.  Zoids are included, named 'zoid'.
+    """
+    query, names = _columns_query(query, columns)
+    cursor = replicas.cursor(conn)
+    try:
+        cursor.execute(query, args)
+        return _columns(names, cursor)
+    finally:
+        _try_to_close_cursor(cursor)
+
+def search_records(conn, query, args, columns):
+    """Return selected data for search results as named tuples
+
+    The arguments are as for search_columns.  Records have a zoid
+    attribute and attributes for the named columns.
+    """
+    query, names = _columns_query(query, columns)
+    Record = collections.namedtuple('Record', ['zoid'] + names)
+    cursor = replicas.cursor(conn)
+    try:
+        cursor.execute(query, args)
+        return [Record(*r) for r in cursor]
+    finally:
+        _try_to_close_cursor(cursor)
+
+@contextlib.contextmanager
+def column_chunks(conn, query, args, columns, chunk_size=500):
+    """Stream selected data for search results in chunks
+
+    The arguments are as for search_columns.  An iterator of column
+    dictionaries, with at most chunk_size values each, is returned.
+    Results are read with a server-side cursor.
+    """
+    query, names = _columns_query(query, columns)
+    cursor = replicas.cursor(conn, str(time.time()))
+    cursor.itersize = chunk_size
+    cursor.execute(query, args)
+
+    def chunks():
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield _columns(names, rows)
+
+    try:
+        yield chunks()
+    finally:
+        _try_to_close_cursor(cursor)
+
+def search_batch(conn, query, args, batch_start, batch_size, prefetch=False):
+    if isinstance(query, Statement):
+        query, args = query.batch(args, batch_start, batch_size, prefetch)
     else:
+        query = """
+        select zoid, class_pickle, count(*) over()
+        from (%s) _
+        offset %s limit %s
+        """ % (query, batch_start, batch_size)
+        if prefetch:
+            query = prefetch_query(query)
+
+    start = time.time()
+    cursor = replicas.cursor(conn)
+    _execute(cursor, query, args)
+    try:
+        get, _ = _object_getter(conn, cursor)
+        rows = cursor.fetchall()
+        count = rows[-1][2] if rows else 0
+        result = [get(r) for r in _visible(conn, cursor, rows)]
+        _trace('search_batch', cursor, query, args, start,
+               len(result), len(result))
+    finally:
         _try_to_close_cursor(cursor)
+    return count, result
+
+placeholders = re.compile(r'%(?:\((\w+)\))?s|%%')
+
+# Names of the statements prepared on each database connection
+_prepared = weakref.WeakKeyDictionary()
+
+class Statement:
+    """A query that's prepared on each connection it's executed on
+
+    The query uses psycopg2 parameter placeholders, either all
+    positional or all named.  It's prepared, as a server-side prepared
+    statement, the first time it's executed on a load connection and
+    executed by name after that, so it isn't parsed and, usually,
+    isn't planned again.
+
+    Statements can be passed to search and search_batch in place of
+    query text.  They're typically created once, at module level.
+    """
+
+    def __init__(self, query, name=None):
+        self.query = query
+        self.name = name or 'rsjs_' + hashlib.sha1(query).hexdigest()[:16]
+        self.names = names = []
+        positions = []
+
+        def replace(match):
+            text = match.group(0)
+            if text == '%%':
+                return '%'
+            name = match.group(1)
+            if name is None:
+                positions.append(None)
+                return '$%s' % len(positions)
+            if name not in names:
+                names.append(name)
+            return '$%s' % (names.index(name) + 1)
+
+        self.sql = placeholders.sub(replace, query)
+        if names and positions:
+            raise ValueError(
+                "Statements can't mix named and positional parameters")
+        self.nargs = len(names) or len(positions)
+        self._batches = {}
+
+    def execute(self, cursor, args=()):
+        conn = cursor.connection
+        prepared = _prepared.get(conn)
+        if prepared is None:
+            prepared = _prepared[conn] = set()
+        if self.name not in prepared:
+            cursor.execute("prepare %s as %s" % (self.name, self.sql))
+            prepared.add(self.name)
+        cursor.execute(*self.execute_sql(args))
+
+    def execute_sql(self, args=()):
+        """Return SQL and arguments to execute the prepared statement
+        """
+        if self.names:
+            args = [args[name] for name in self.names]
+        else:
+            args = list(args or ())
+        if len(args) != self.nargs:
+            raise TypeError("Expected %s arguments, got %s"
+                            % (self.nargs, len(args)))
+        if args:
+            return ("execute %s (%s)"
+                    % (self.name, ', '.join(['%s'] * len(args))),
+                    args)
+        else:
+            return "execute " + self.name, None
+
+    def batch(self, args, batch_start, batch_size, prefetch=False):
+        """Return a statement and arguments for a batch of results
+        """
+        batch = self._batches.get(prefetch)
+        if batch is None:
+            if self.names:
+                tail = "offset %(batch_start)s limit %(batch_size)s"
+            else:
+                tail = "offset %s limit %s"
+            query = ("select zoid, class_pickle, count(*) over()"
+                     " from (" + self.query + ") _ " + tail)
+            if prefetch:
+                query = prefetch_query(query)
+            batch = self._batches[prefetch] = Statement(query)
+
+        if self.names:
+            args = dict(args, batch_start=batch_start, batch_size=batch_size)
+        else:
+            args = tuple(args or ()) + (batch_start, batch_size)
+        return batch, args
+
+def _execute(cursor, query, args):
+    if isinstance(query, Statement):
+        query.execute(cursor, args)
+    else:
+        cursor.execute(query, args)
 
+def _prepared_statements(cursor, replica):
+    cursor.execute("select * from pg_prepared_statements order by name")
+    columns = [d[0] for d in cursor.description] + ['replica']
+    return [dict(zip(columns, r + (replica,))) for r in cursor]
 
-def search_batch(conn, query, args, batch_start, batch_size):
-    query = """
-    select zoid, class_pickle, count(*) over()
-    from (%s) _
-    offset %s limit %s
-    """ % (query, batch_start, batch_size)
+def prepared_statements(conn):
+    """Return information about the statements prepared for searches
 
+    Data from pg_prepared_statements for the connection's load
+    connection, and for idle replica connections if a replica router
+    is installed, are returned as a list of dictionaries.  Their
+    replica items are the replicas' DSNs, or None for the load
+    connection.  In Postgres 14 and later, the generic_plans and
+    custom_plans counts show how often cached plans were reused rather
+    than planned for specific arguments.
+    """
     cursor = conn._storage.ex_cursor()
-    cursor.execute(query, args)
-    get = conn.ex_get
     try:
-        result = [get(p64(zoid), class_pickle)
-                  for (zoid, class_pickle, count) in cursor]
-        return count, result
+        result = _prepared_statements(cursor, None)
     finally:
         _try_to_close_cursor(cursor)
 
+    router = replicas.router
+    if router is not None:
+        for replica in router.take_idle():
+            cursor = replicas.ReplicaCursor(router, replica, None, None)
+            try:
+                result.extend(_prepared_statements(cursor, replica.dsn))
+            finally:
+                cursor.close()
+    return result
+
 def search(conn, query, *args, **kw):
-    cursor = conn._storage.ex_cursor()
-    cursor.execute(query, args or kw)
+    start = time.time()
+    cursor = replicas.cursor(conn)
+    _execute(cursor, query, args or kw)
     try:
-        first = True
+        rows = _visible(conn, cursor, cursor.fetchall())
         result = []
-        get = conn.ex_get
-        for r in cursor:
-            if first:
-                indexes = {d[0]: index
-                           for (index, d) in enumerate(cursor.description)}
-                zoid_index = indexes['zoid']
-                class_pickle_index = indexes['class_pickle']
-                first = False
-            ob = get(p64(r[zoid_index]), r[class_pickle_index])
-            result.append(ob)
-
-        if result:
-            conn.prefetch(result)
-
-        return result
+        if rows:
+            get, prefetched = _object_getter(conn, cursor)
+            result = [get(r) for r in rows]
+            if not prefetched:
+                conn.prefetch(result)
+        _trace('search', cursor, query, args or kw, start,
+               len(result), len(result))
+    finally:
+        _try_to_close_cursor(cursor)
+    return result
+
+def prefetch_search(conn, query, *args, **kw):
+    """Search, setting the states of the objects found
+
+    Results are returned in one round trip, rather than one for the
+    search and one for each object used.
+    """
+    return search(conn, prefetch_query(query), *args, **kw)
+
+many_sql = """
+select %s as search_index, zoid, class_pickle,
+       row_number() over () as search_n, null::json as search_row
+from (%s) _
+"""
+
+many_rows_sql = """
+select %s as search_index, null::bigint as zoid, null::bytea as class_pickle,
+       row_number() over () as search_n, to_json(_) as search_row
+from (%s) _
+"""
+
+def search_many(conn, queries, prefetch=False):
+    """Run several searches in one round trip
+
+    queries is a sequence of (query, args) pairs.  The queries are
+    combined with ``union all``, after their arguments are bound, and
+    executed together.  A list of result lists is returned, in the
+    order of the queries.
+
+    Queries can also be given as (query, args, True) triples, in
+    which case their rows, such as counts, are returned as
+    dictionaries, mapping column names to JSON-decoded values, rather
+    than as objects.
+
+    Objects for all of the results are created in a single pass, and
+    if prefetch is true, their states are read with the results, as
+    for prefetch_query.
+    """
+    if not queries:
+        return []
+    cursor = replicas.cursor(conn)
+    try:
+        parts = []
+        for i, q in enumerate(queries):
+            sql = many_rows_sql if len(q) > 2 and q[2] else many_sql
+            parts.append(sql % (i, cursor.mogrify(q[0], q[1])))
+        query = ' union all '.join(parts)
+        query = "select * from (%s) _ order by search_index, search_n" % query
+        if prefetch:
+            query = prefetch_query(query)
+
+        start = time.time()
+        cursor.execute(query)
+        results = [[] for q in queries]
+        objects = []
+        get, prefetched = _object_getter(conn, cursor)
+        row_index = [d[0] for d in cursor.description].index('search_row')
+        for r in _visible(conn, cursor, cursor.fetchall()):
+            if r[row_index] is not None:
+                results[r[0]].append(r[row_index])
+                continue
+            ob = get(r)
+            results[r[0]].append(ob)
+            objects.append(ob)
+        if objects and not prefetched:
+            conn.prefetch(objects)
+        _trace('search_many', cursor, query, None, start,
+               len(objects), len(objects))
     finally:
         _try_to_close_cursor(cursor)
+    return results
+
+
+page_sql = """
+select * from (%s) _
+%s
+order by %s
+limit %s
+"""
+
+def encode_token(key):
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+def decode_token(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid continuation token", token)
+
+def exact_total(cursor, query, args):
+    """Count all of the results of a query
+
+    A (count, exact) tuple is returned, as for all total functions.
+    """
+    cursor.execute("select count(*) from (%s) _" % query, args)
+    [[count]] = cursor.fetchall()
+    return count, True
+
+def capped_total(cap):
+    """Return a total function that counts no more than cap results
+
+    If there are more, (cap, False) is returned, which can be shown
+    as, for example, "1000+".
+    """
+    def total(cursor, query, args):
+        cursor.execute(
+            "select count(*) from (select from (%s) _ limit %s) _" % (
+                query, cap + 1),
+            args)
+        [[count]] = cursor.fetchall()
+        if count > cap:
+            return cap, False
+        return count, True
+    return total
+
+def estimated_total(cursor, query, args):
+    """Return the planner's estimate of the number of results
+    """
+    cursor.execute("explain (format json) " + query, args)
+    [[plan]] = cursor.fetchall()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows']), False
+
+def search_page(conn, query, args, sort, size,
+                token=None, total=None, descending=False, prefetch=False):
+    """Return a page of search results, using keyset pagination
+
+    Rather than skipping rows with an offset, each page starts after
+    the sort key of the previous page's last row, so the cost of
+    getting a page doesn't depend on how deep it is, given an index
+    that supports the sort.
+
+    sort is a sequence of column names, output by the query, that
+    uniquely identify results, for example ('title', 'zoid').  Results
+    are sorted by them, in descending order if descending is true.
+    Sort values must be JSON serializable.
+
+    token is None for the first page, and otherwise the continuation
+    token returned with the previous page.
+
+    total is an optional function, like exact_total, capped_total(n) or
+    estimated_total, used to compute the total number of results.
+    It's usually only passed when getting the first page.
+
+    A (results, token, total) tuple is returned.  token is None if
+    there are no more results, and total is a (count, exact) tuple, or
+    None if no total function was given.
+    """
+    columns = ', '.join('_.' + name for name in sort)
+    if isinstance(args, dict):
+        args = dict(args)
+    else:
+        args = tuple(args or ())
+
+    where = ''
+    page_args = args
+    if token is not None:
+        key = decode_token(token)
+        if len(key) != len(sort):
+            raise ValueError("Invalid continuation token", token)
+        if isinstance(args, dict):
+            names = ['page_key_%s' % i for i in range(len(key))]
+            page_args = dict(args, **dict(zip(names, key)))
+            placeholders = ', '.join('%%(%s)s' % name for name in names)
+        else:
+            page_args = args + tuple(key)
+            placeholders = ', '.join(['%s'] * len(key))
+        where = 'where (%s) %s (%s)' % (
+            columns, '<' if descending else '>', placeholders)
+
+    order = ', '.join(
+        '_.%s%s' % (name, ' desc' if descending else '') for name in sort)
+    page_query = page_sql % (query, where, order, size + 1)
+    if prefetch:
+        page_query = prefetch_query(page_query)
+
+    cursor = replicas.cursor(conn)
+    try:
+        cursor.execute(page_query, page_args)
+        rows = cursor.fetchall()
+        result = []
+        if rows:
+            get, _ = _object_getter(conn, cursor)
+            indexes = [[d[0] for d in cursor.description].index(name)
+                       for name in sort]
+            result = [get(r) for r in _visible(conn, cursor, rows[:size])]
+
+        token = None
+        if len(rows) > size:
+            token = encode_token([rows[size - 1][i] for i in indexes])
+
+        if total is not None:
+            total = total(cursor, query, args)
+
+        return result, token, total
+    finally:
+        _try_to_close_cursor(cursor)
+
+
+class LRUBackend:
+    """In-process storage for cached results
+
+    Values are strings.  The least recently used values are evicted
+    when there are more than max_entries values or their total size
+    exceeds max_bytes.
+
+    Cache backends need only have get and set methods like these.
+    Keys and values are strings, so, for example, a memcache client
+    can be used as a backend, sharing results between processes.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=10 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.data = collections.OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(value) > self.max_bytes:
+                return
+            self.data[key] = value
+            self.size += len(value)
+            while (len(self.data) > self.max_entries or
+                   self.size > self.max_bytes):
+                _, old = self.data.popitem(False)
+                self.size -= len(old)
+                self.evictions += 1
+
+_whitespace = re.compile(r"(%s)|\s+" % tracing._literals.pattern)
+
+def _normalize_whitespace(query):
+    """Collapse whitespace in query text, except in literals
+    """
+    return _whitespace.sub(lambda m: m.group(1) or ' ', query).strip()
+
+class ResultCache:
+    """Cache of search results
+
+    Results are cached by normalized query text and arguments, and
+    are reused until object_json changes: until the updater commits,
+    advancing object_json_tid, or a redo or gc run increments its
+    generation.  Only zoids and class pickles are cached, so the
+    objects returned are those of the connection searched.
+
+    Results are stored in a backend, an LRUBackend by default.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = LRUBackend() if backend is None else backend
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.stale = 0
+
+    def key(self, query, args):
+        if isinstance(args, dict):
+            args = sorted(args.items())
+        return hashlib.sha1(
+            '%s\0%r' % (_normalize_whitespace(query), args)).hexdigest()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(hits=self.hits, misses=self.misses, stale=self.stale)
+        for name in 'size', 'evictions':
+            if hasattr(self.backend, name):
+                stats[name] = getattr(self.backend, name)
+        return stats
+
+    def _count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _cached(self, conn, query, args, compute, use):
+        """Return a cached value, computing it if necessary
+
+        compute is called with a cursor on which the query has been
+        executed.  The value is checked against object_json_tid, and
+        its generation, read using the same cursor, and thus snapshot,
+        as searches.  The result of calling use with the cursor and
+        the value is returned.
+        """
+        cursor = replicas.cursor(conn)
+        try:
+            cursor.execute("select tid, generation from object_json_tid")
+            [version] = cursor.fetchall()
+            key = self.key(query, args)
+            cached = self.backend.get(key)
+            if cached is not None:
+                cached_version, value = marshal.loads(cached)
+                if cached_version == version:
+                    self._count('hits')
+                    return use(cursor, value)
+                self._count('stale')
+            self._count('misses')
+            cursor.execute(query, args)
+            value = compute(cursor)
+            self.backend.set(key, marshal.dumps((version, value)))
+            return use(cursor, value)
+        finally:
+            _try_to_close_cursor(cursor)
+
+    def search(self, conn, query, *args, **kw):
+        """Search, like the search function, using cached results
+        """
+        def compute(cursor):
+            indexes = {d[0]: index
+                       for (index, d) in enumerate(cursor.description)}
+            zoid_index = indexes['zoid']
+            class_pickle_index = indexes['class_pickle']
+            return [(r[zoid_index], bytes(r[class_pickle_index]))
+                    for r in cursor]
+
+        def use(cursor, rows):
+            return _visible(conn, cursor, rows, 0)
+
+        get = conn.ex_get
+        return [get(p64(zoid), class_pickle)
+                for (zoid, class_pickle)
+                in self._cached(conn, query, args or kw, compute, use)]
+
+    def search_batch(self, conn, query, args, batch_start, batch_size):
+        """Search, like search_batch, using cached results
+        """
+        query = """
+        select zoid, class_pickle, count(*) over()
+        from (%s) _
+        offset %s limit %s
+        """ % (query, batch_start, batch_size)
+
+        def compute(cursor):
+            count = 0
+            rows = []
+            for (zoid, class_pickle, count) in cursor:
+                rows.append((zoid, bytes(class_pickle)))
+            return count, rows
+
+        def use(cursor, value):
+            count, rows = value
+            return count, _visible(conn, cursor, rows, 0)
+
+        count, rows = self._cached(conn, query, args, compute, use)
+        get = conn.ex_get
+        return count, [get(p64(zoid), class_pickle)
+                       for (zoid, class_pickle) in rows]
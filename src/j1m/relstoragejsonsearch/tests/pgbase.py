@@ -14,7 +14,8 @@ class O(persistent.Persistent):
 
 class PGTestBase(unittest.TestCase):
 
-    tables = 'object_state object_json object_json_tid'.split()
+    tables = ('object_state object_json object_json_tid'
+              ' object_json_backfill').split()
 
     def setUp(self):
         conn = self.conn = psycopg2.connect('')
@@ -71,8 +72,9 @@ class PGTestBase(unittest.TestCase):
         updater.setup_object_json(self.cursor)
 
     def drop_trigger(self):
-        self.ex("drop trigger trigger_notify_object_state_changed"
-                " on object_state")
+        for event in 'inserted', 'updated':
+            self.ex("drop trigger trigger_notify_object_state_%s"
+                    " on object_state" % event)
 
     def last_tid(self, expect=None):
         try:
@@ -147,6 +147,18 @@ class Tests(unittest.TestCase):
                   (11123,), (11131,), (11132,), (11133,)]
         self.assertEqual(self.search("read", "bob"), expect)
 
+    def test_parameters(self):
+        self.acl(111, [('Allow', "bob", "read")])
+        search = "select * from docs where zoid > %(lo)s"
+        self.assertEqual(
+            sorted(filteredsearch(
+                search, None, None, docid='zoid', cursor=self.cursor,
+                args=dict(lo=11120, permission='read', principals=['bob']))),
+            [(11121,), (11122,), (11123,), (11131,), (11132,), (11133,)])
+        with self.assertRaises(ValueError):
+            filteredsearch(search, None, None, docid='zoid',
+                           cursor=self.cursor)
+
     def test_sql_retrieval(self):
         sql = filteredsearch("select * from docs", 'read', ('bob', 'all'))
         self.assertEqual(sql.strip().split(), expected_filtered_query)
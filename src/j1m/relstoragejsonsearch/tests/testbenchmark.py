@@ -0,0 +1,63 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from .. import benchmark
+
+class BenchmarkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_corpus_is_reproducible(self):
+        records = benchmark.corpus(3)
+        self.assertEqual(
+            sorted(records),
+            ['btree_buckets', 'cached_data', 'content', 'datetimes',
+             'references', 'shared_cyclic'])
+        self.assertEqual(set(len(r) for r in records.values()), set([3]))
+        def data(records):
+            return dict((name, [r[1:] for r in rs])
+                        for (name, rs) in records.items())
+        self.assertEqual(data(benchmark.corpus(3)), data(records))
+
+    def test_baseline(self):
+        path = os.path.join(self.tmp, 'baseline.json')
+        with mock.patch('sys.stdout'):
+            benchmark.main(['-n2', '-t0', '--save-baseline', path])
+        with open(path) as f:
+            baseline = json.load(f)
+        self.assertEqual(len(baseline), 18)
+        self.assertEqual(sorted(baseline['content.jsonify']),
+                         ['peak_kib', 'rate'])
+        self.assertEqual(set(type(r['peak_kib']) for r in baseline.values()),
+                         set([float]))
+
+        # A much faster baseline causes failure:
+        baseline['content.jsonify']['rate'] *= 100
+        with open(path, 'w') as f:
+            json.dump(baseline, f)
+        with mock.patch('sys.stdout') as stdout:
+            with self.assertRaises(SystemExit) as exc:
+                benchmark.main(['-n2', '-t0', '-b', path])
+        self.assertEqual(exc.exception.code, 1)
+        self.assertTrue('REGRESSION content.jsonify:' in
+                        ''.join(c[0][0] for c in stdout.write.call_args_list))
+
+    def test_regressions(self):
+        baseline = dict(a=dict(rate=100), b=dict(rate=100))
+        results = dict(a=dict(rate=80), b=dict(rate=70), c=dict(rate=1))
+        self.assertEqual(benchmark.regressions(results, baseline, .25),
+                         [('b', 70, 100)])
+
+    def test_peak_kib(self):
+        kept = []
+        def func(record):
+            # Large enough to be allocated with fresh pages by malloc.
+            kept.append('x' * (40 << 20))
+        self.assertTrue(benchmark.peak_kib(func, range(2)) >= 70 << 10)
+        self.assertEqual(kept, []) # Records were converted in a child process
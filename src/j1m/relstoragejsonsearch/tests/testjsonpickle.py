@@ -14,11 +14,14 @@
 from cStringIO import StringIO
 import datetime
 import json
+import mock
+import persistent
 from persistent.mapping import PersistentMapping
 import pickle
 from pprint import pprint
 import unittest
 import ZODB
+import ZODB.serialize
 from ZODB.utils import z64, p64, maxtid
 
 from ..jsonpickle import JsonUnpickler
@@ -131,3 +134,256 @@ class JsonUnpicklerTests(unittest.TestCase):
         _ = self.load()
         _ = self.load()
 
+
+    def test_class_name(self):
+        from ..jsonpickle import class_name
+        self.root.x = 1
+        self.commit()
+        p, _, _ = self.db.storage.loadBefore(z64, maxtid)
+        self.assertEqual(class_name(p), 'persistent.mapping.PersistentMapping')
+
+        # Classes with arguments, and newer protocols:
+        for proto in 1, 2:
+            p = pickle.dumps((initful, (1, 2)), proto)
+            self.assertEqual(
+                class_name(p),
+                'j1m.relstoragejsonsearch.tests.testjsonpickle.initful')
+
+        # Pickles that don't start with a global aren't recognized:
+        self.assertEqual(class_name(pickle.dumps((('m', 'C'), None), 1)),
+                         None)
+        self.assertEqual(class_name('cmodule\n'), None)
+        self.assertEqual(class_name(''), None)
+
+    def emit(self):
+        self.conn.transaction_manager.commit()
+        p, _, _ = self.db.storage.loadBefore(z64, maxtid)
+        from ..jsonpickle import JsonEmitter
+        emitter = JsonEmitter(StringIO(p))
+        emitter.skip()
+        return emitter.load()
+
+    def test_emitter(self):
+        root = self.root
+        root.numbers = 0, 123456789, 1 << 70, 1234.56789, True, None
+        root.time = datetime.datetime(2001, 2, 3, 4, 5, 6, 7)
+        root.date = datetime.datetime(2001, 2, 3)
+        root.delta = datetime.timedelta(1, 2, 3)
+        root.name = u'root \u1234'
+        root.data = b'\xff'
+        root.list = [1, 2, 3, root.name, root.numbers]
+        root.shared = root.list
+        root.first = PersistentMapping()
+        root.ob = initful(1, 2)
+        root.ob.x = 1
+        root.keys = {1: 2, 'a': 'b'}
+        for i in range(2):
+            emitted = json.loads(self.emit())
+            self.commit(None)
+            self.load()
+            self.assertEqual(emitted, self.load())
+            # Without non-ascii bytes, the C encoder is used:
+            root.data = b'data'
+
+    def test_emitter_instance_states(self):
+        import pickletools
+        from ..jsonpickle import JsonEmitter
+        ob = newstyle()
+        ob.y = initful(1)
+        for proto in 0, 1:
+            p = pickle.dumps(ob, proto)
+            # Without memoization, JsonUnpickler merges dictionary
+            # states into instances:
+            for p in p, pickletools.optimize(p):
+                self.assertEqual(json.loads(JsonEmitter(StringIO(p)).load()),
+                                 json.loads(JsonUnpickler(p).load()))
+
+        p = pickletools.optimize(pickle.dumps(initful(1), 1))
+        self.assertEqual(
+            json.loads(JsonEmitter(StringIO(p)).load()),
+            {u'::': u'j1m.relstoragejsonsearch.tests.testjsonpickle.initful',
+             u'__class_args__': [1], u'args': [1]})
+
+    def test_large_binary_data_are_described(self):
+        from ..jsonpickle import JsonEmitter
+        import hashlib
+        data = b'\xff' * 100
+        self.root.small = b'\xff'
+        self.root.large = data
+        self.conn.transaction_manager.commit()
+        p, _, _ = self.db.storage.loadBefore(z64, maxtid)
+        expected = {u'data': {
+            u'small': {u'::': u'hex', u'hex': u'ff'},
+            u'large': {u'::': u'bytes', u'length': 100,
+                       u'md5': hashlib.md5(data).hexdigest()},
+            }}
+        unpickler = JsonUnpickler(p, binary_limit=99)
+        unpickler.skip()
+        self.assertEqual(json.loads(unpickler.load()), expected)
+        emitter = JsonEmitter(StringIO(p), binary_limit=99)
+        emitter.skip()
+        self.assertEqual(json.loads(emitter.load()), expected)
+
+        # Data may be decoded before they're converted:
+        emitter = JsonEmitter(StringIO(p), binary_limit=99)
+        emitter.skip()
+        self.assertEqual(
+            json.loads(emitter.load(lambda state: len(state['data']))), 2)
+
+    def test_projection(self):
+        from ..jsonpickle import JsonEmitter
+        ob = Content()
+        ob.title = u'root'
+        ob.history = [1]
+        ob.history.append(ob.history)
+        p = ZODB.serialize.ObjectWriter().serialize(ob)
+
+        # Unlisted attributes aren't converted, so cycles in them
+        # don't matter:
+        emitter = JsonEmitter(StringIO(p))
+        emitter.skip()
+        self.assertEqual(
+            json.loads(emitter.load(attributes={'title', 'nope'})),
+            {u'title': u'root'})
+        unpickler = JsonUnpickler(p)
+        unpickler.skip()
+        unpickler.attributes = {'title'}
+        self.assertEqual(json.loads(unpickler.load()), {u'title': u'root'})
+        self.assertFalse(unpickler._x_cyclic)
+
+    def test_emitter_surrogates(self):
+        self.root.name = u'a\U0001F600b\ud800c'
+        self.assertEqual(json.loads(self.emit()),
+                         {u'data': {u'name': u'a  b c'}})
+
+    def test_emitter_doesnt_handle_cycles(self):
+        from ..jsonpickle import Unsupported
+        self.root.list = [1]
+        self.root.list.append(self.root.list)
+        with self.assertRaises(Unsupported):
+            self.emit()
+
+    def test_cycles_are_detected_while_unpickling(self):
+        self.root.x = self.root.y = [1]
+        self.commit()
+        self.load()
+        with mock.patch('json.dumps', side_effect=json.dumps) as dumps:
+            self.assertEqual(self.load(), {u'data': {u'x': [1], u'y': [1]}})
+            self.assertEqual(len(dumps.call_args_list), 1)
+        self.assertTrue(self.unpickler._x_got)
+        self.assertFalse(self.unpickler._x_cyclic)
+
+        self.root.x.append(self.root.x)
+        self.conn.root()._p_changed = True
+        self.commit()
+        self.load()
+        with mock.patch('json.dumps', side_effect=json.dumps) as dumps:
+            data = self.load()
+            self.assertEqual(len(dumps.call_args_list), 1)
+        self.assertTrue(self.unpickler._x_cyclic)
+        self.assertEqual(sorted(v['::'] for v in data['data'].values()),
+                         ['ref', 'shared'])
+
+    def test_cyclic_records_are_counted(self):
+        from ..updater import Converter
+        self.root.x = [1]
+        self.root.x.append(self.root.x)
+        self.conn.transaction_manager.commit()
+        p, tid, _ = self.db.storage.loadBefore(z64, maxtid)
+        convert = Converter(lambda zoid, class_name, state: state)
+        [result] = convert([(1, 0, p, None)])
+        self.assertEqual(json.loads(result[4])['data']['x']['::'], 'shared')
+        self.assertEqual(convert.metrics.counters['records_cyclic'], 1)
+        self.assertEqual(convert.metrics.counters['records_converted'], 1)
+
+    def test_decoders_dont_depend_on_class_sniffing(self):
+        import binascii
+        import cPickle
+        import zlib
+        from zope.testing.loggingsupport import InstalledHandler
+        from ..jsonpickle import class_name
+        from ..updater import Converter, decode_cached_data
+        # An old-style class pickle, with the class as a tuple:
+        class_pickle = cPickle.dumps((('karl.files', '_CachedData'), None), 1)
+        self.assertEqual(class_name(class_pickle), None)
+        data = zlib.compress('hello')
+        cyclic = dict(data=data)
+        cyclic['self'] = cyclic
+        # A protocol 4 state, which zodbpickle's unpickler can't load:
+        protocol4 = ('\x80\x04}\x8c\x04dataU%s%ss.' % (chr(len(data)), data))
+        convert = Converter(lambda zoid, class_name, state: state,
+                            decoders=[('karl.files._CachedData',
+                                       decode_cached_data)])
+        handler = InstalledHandler('j1m.relstoragejsonsearch.updater')
+        try:
+            results = convert([
+                (1, 1, class_pickle + cPickle.dumps(dict(data=data), 1), None),
+                (1, 2, class_pickle + cPickle.dumps(cyclic, 1), None),
+                (1, 3, class_pickle + protocol4, None),
+                ])
+        finally:
+            handler.uninstall()
+        self.assertEqual([json.loads(r[4]) for r in results[:2]],
+                         [{u'text': u'hello'}] * 2)
+
+        # States that can't be decoded are logged and counted:
+        self.assertEqual(json.loads(results[2][4]),
+                         {u'data': {u'::': u'hex',
+                                    u'hex': binascii.b2a_hex(data)}})
+        self.assertEqual(str(handler),
+                         'j1m.relstoragejsonsearch.updater WARNING\n'
+                         "  Couldn't decode karl.files._CachedData record 3")
+        self.assertEqual(convert.metrics.counters['records_undecoded'], 1)
+
+    def test_buffers_and_protocols(self):
+        from zodbpickle import binary, pickle as zpickle
+        data = [u'x', 'y', binary('\xff'), 1 << 70, -1 << 70,
+                (1,), (1, 2), (1, 2, 3), initful(1), initful(2)]
+        data.append(data[-1])
+        expected = json.loads(JsonUnpickler(zpickle.dumps(data, 1)).load())
+        for proto in 2, 3:
+            p = zpickle.dumps(data, proto)
+            for d in p, buffer(p), memoryview(p), StringIO(p):
+                unpickler = JsonUnpickler(d)
+                self.assertEqual(json.loads(unpickler.load()), expected)
+                self.assertEqual(unpickler.tell(), len(p))
+
+        # Newer classes are pickled with NEWOBJ
+        p = zpickle.dumps(newstyle(), 2)
+        self.assertEqual(
+            json.loads(JsonUnpickler(p).load()),
+            {u'::': u'j1m.relstoragejsonsearch.tests.testjsonpickle.newstyle',
+             u'state': {u'x': 1}})
+
+        # Protocol 4 framing and short unicode strings:
+        p = ('\x80\x04\x95\x07\x00\x00\x00\x00\x00\x00\x00'
+             '\x8c\x02hi\x94h\x00\x86.')
+        self.assertEqual(json.loads(JsonUnpickler(p).load()), [u'hi', u'hi'])
+
+        # Protocol 4 sets, represented like sets pickled with older
+        # protocols:
+        p = ('\x80\x04\x95\x18\x00\x00\x00\x00\x00\x00\x00]\x94(\x8f\x94('
+             'K\x01K\x02\x90(K\x03\x91\x94\x8f\x94(K\x04\x90e.')
+        self.assertEqual(
+            json.loads(JsonUnpickler(p).load()),
+            json.loads(JsonUnpickler(
+                pickle.dumps([set([1, 2]), frozenset([3]), set([4])], 2)
+                ).load()))
+
+        # 8-byte lengths, and NEWOBJ_EX, whose keyword arguments are
+        # passed last:
+        p = ('\x80\x04]\x94(\x8d\x02\x00\x00\x00\x00\x00\x00\x00hi'
+             '\x8e\x01\x00\x00\x00\x00\x00\x00\x00\xff'
+             '\x8c\x01m\x8c\x01C\x93\x94K\x01\x85}\x94\x8c\x01bK\x02s\x92e.')
+        self.assertEqual(
+            json.loads(JsonUnpickler(p).load()),
+            [u'hi', {u'::': u'hex', u'hex': u'ff'},
+             {u'::': u'm.C', u'__class_args__': [1, {u'b': 2}]}])
+
+class Content(persistent.Persistent):
+    pass
+
+class newstyle(object):
+
+    def __init__(self):
+        self.x = 1
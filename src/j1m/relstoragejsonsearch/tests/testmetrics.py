@@ -0,0 +1,62 @@
+import unittest
+import urllib2
+
+from ..metrics import Metrics, serve
+
+class MetricsTests(unittest.TestCase):
+
+    def test_conversions(self):
+        metrics = Metrics(top=2)
+        metrics.note_conversion('converted', 'a.A', 1, .0002)
+        metrics.note_conversion('converted', 'a.A', 2, .002)
+        metrics.note_conversion('converted', 'b.B', 3, .02)
+        metrics.note_conversion('skipped', 'BTrees.OOBTree.OOBTree', 4, 0)
+        metrics.note_conversion('unchanged', None, 5, 0)
+        metrics.note_failure(6)
+        metrics.incr('records_read', 6)
+
+        self.assertEqual(metrics.slowest_conversions(),
+                         [(.02, 3, 'b.B'), (.002, 2, 'a.A')])
+
+        text = metrics.text().split('\n')
+        for line in [
+            'rs_json_updater_records_read_total 6',
+            'rs_json_updater_records_converted_total 3',
+            'rs_json_updater_records_skipped_total 1',
+            'rs_json_updater_records_unchanged_total 1',
+            'rs_json_updater_records_failed_total 1',
+            '# TYPE rs_json_updater_conversion_seconds histogram',
+            'rs_json_updater_conversion_seconds_bucket{class="a.A",le="0.0001"} 0',
+            'rs_json_updater_conversion_seconds_bucket{class="a.A",le="0.0003"} 1',
+            'rs_json_updater_conversion_seconds_bucket{class="a.A",le="0.003"} 2',
+            'rs_json_updater_conversion_seconds_bucket{class="a.A",le="+Inf"} 2',
+            'rs_json_updater_conversion_seconds_count{class="a.A"} 2',
+            'rs_json_updater_conversion_seconds_count{class="b.B"} 1',
+            'rs_json_updater_slowest_conversion_seconds{zoid="3",class="b.B"} 0.02',
+            'rs_json_updater_failed_zoid{zoid="6"} 1',
+            ]:
+            self.assertTrue(line in text, line)
+
+    def test_lag(self):
+        from ZODB.TimeStamp import TimeStamp
+        from ZODB.utils import u64
+        metrics = Metrics()
+        self.assertEqual(metrics.lag(), 0)
+        metrics.object_json_tid = u64(TimeStamp(2017, 1, 1, 0, 0, 0).raw())
+        metrics.object_state_tid = u64(TimeStamp(2017, 1, 1, 0, 1, 0).raw())
+        self.assertEqual(metrics.lag(), 60)
+        self.assertTrue(
+            'rs_json_updater_lag_seconds 60.000' in metrics.text().split('\n'))
+
+    def test_serve(self):
+        metrics = Metrics()
+        metrics.incr('commits')
+        server = serve(metrics, 0, 'localhost')
+        try:
+            text = urllib2.urlopen(
+                'http://localhost:%s/metrics' % server.server_address[1]
+                ).read()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(text, metrics.text())
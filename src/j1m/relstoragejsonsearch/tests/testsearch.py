@@ -1,7 +1,10 @@
+import mock
+import os
 import unittest
 from ZODB import utils
 import ZODB.config
 import relstorage
+from zope.testing.loggingsupport import InstalledHandler
 
 from . import pgbase
 
@@ -128,3 +131,582 @@ class Tests(pgbase.PGTestBase):
 
         # We didn't end up with all of the objects getting loaded:
         self.assertEqual(len(conn2._cache), 20)
+
+    def test_prefetch(self):
+        self.start_updater()
+        for i in range(9):
+            tid = self.store(i, i=i)
+        self.wait_tid(tid)
+
+        from ..search import prefetch_search
+        from ..search import search_batch, search_iterator
+        query = ("select zoid, class_pickle from object_json"
+                 " where (state->>'i')::int >= %s order by zoid desc")
+
+        # States are set from the search results, so objects needn't
+        # be loaded:
+        conn2 = self.db.open()
+        with mock.patch.object(conn2._storage, 'load') as load:
+            result = prefetch_search(conn2, query, 5)
+            self.assertEqual([o._p_changed for o in result], [False] * 4)
+            self.assertEqual([o.i for o in result], [8, 7, 6, 5])
+            root = self.conn.root()
+            self.assertEqual([o._p_serial for o in result],
+                             [root[i]._p_serial for i in (8, 7, 6, 5)])
+
+            conn3 = self.db.open()
+            total, batch = search_batch(conn3, query, (2,), 1, 3,
+                                        prefetch=True)
+            self.assertEqual((total, [o.i for o in batch]), (7, [7, 6, 5]))
+
+            conn4 = self.db.open()
+            with search_iterator(conn4, query, (6,), bufsize=2,
+                                 prefetch=True) as it:
+                self.assertEqual([o.i for o in it], [8, 7, 6])
+
+            self.assertEqual(load.call_count, 0)
+
+    def test_search_page(self):
+        self.start_updater()
+        for i in range(25):
+            tid = self.store(i, i=i, parity=i % 2)
+        self.wait_tid(tid)
+
+        from ..search import search_page, decode_token
+        from ..search import exact_total, capped_total, estimated_total
+        query = ("select zoid, class_pickle, (state->>'parity')::int parity"
+                 " from object_json where (state->>'i')::int >= %s")
+
+        conn = self.db.open()
+        pages = []
+        token = None
+        while True:
+            result, token, total = search_page(
+                conn, query, (2,), ('parity', 'zoid'), 10, token,
+                total=exact_total if token is None else None)
+            pages.append([o.i for o in result])
+            if token is None:
+                break
+            self.assertEqual(total, (23, True) if len(pages) == 1 else None)
+
+        zoids = dict((o.i, utils.u64(o._p_oid))
+                     for o in self.conn.root().values())
+        expected = sorted(range(2, 25), key=lambda i: (i % 2, zoids[i]))
+        self.assertEqual(pages, [expected[:10], expected[10:20],
+                                 expected[20:]])
+
+        # Named arguments, descending order and other totals:
+        query = ("select zoid, class_pickle from object_json"
+                 " where (state->>'i')::int >= %(lo)s")
+        result, token, total = search_page(
+            conn, query, dict(lo=2), ('zoid',), 20,
+            descending=True, total=capped_total(10), prefetch=True)
+        self.assertEqual(total, (10, False))
+        self.assertEqual(decode_token(token),
+                         [sorted(zoids.values(), reverse=True)[19]])
+        result, token, total = search_page(
+            conn, query, dict(lo=2), ('zoid',), 20, token,
+            descending=True, total=capped_total(100))
+        self.assertEqual(len(result), 3)
+        self.assertEqual((token, total), (None, (23, True)))
+        _, _, (count, exact) = search_page(
+            conn, query, dict(lo=2), ('zoid',), 1, total=estimated_total)
+        self.assertFalse(exact)
+
+        with self.assertRaises(ValueError):
+            search_page(conn, query, dict(lo=2), ('zoid',), 1, 'xxx')
+
+    def test_result_cache(self):
+        self.start_updater()
+        for i in range(9):
+            tid = self.store(i, i=i)
+        self.wait_tid(tid)
+
+        from ..search import ResultCache
+        cache = ResultCache()
+        query = ("select zoid, class_pickle from object_json"
+                 " where (state->>'i')::int >= %s order by zoid")
+        conn = self.db.open()
+        self.assertEqual([o.i for o in cache.search(conn, query, 6)],
+                         [6, 7, 8])
+        # Whitespace differences don't matter:
+        self.assertEqual(
+            [o.i for o in cache.search(conn, query.replace(' ', '\n  '), 6)],
+            [6, 7, 8])
+        self.assertEqual(cache.search_batch(conn, query, (6,), 1, 1)[0], 3)
+        self.assertEqual(cache.search_batch(conn, query, (6,), 1, 1)[0], 3)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stale']),
+                         (2, 2, 0))
+
+        # But whitespace in literals does:
+        literal_query = ("select zoid, class_pickle from object_json"
+                         " where %s = 'a  b' order by zoid")
+        self.assertEqual(len(cache.search(conn, literal_query, 'a  b')), 10)
+        self.assertEqual(
+            cache.search(conn, literal_query.replace('  ', ' '), 'a  b'), [])
+        self.assertEqual(cache.stats()['misses'], 4)
+
+        # When the updater commits, cached results are recomputed:
+        tid = self.store(9, i=9)
+        self.wait_tid(tid)
+        conn.transaction_manager.abort() # see the new data
+        self.assertEqual([o.i for o in cache.search(conn, query, 6)],
+                         [6, 7, 8, 9])
+        self.assertEqual(cache.stats()['stale'], 1)
+
+        # Redo and gc change object_json without advancing its tid, so
+        # they increment its generation:
+        from ..updater import main
+        main(['', '--redo-zoids', '1-99'])
+        conn.transaction_manager.abort()
+        self.assertEqual([o.i for o in cache.search(conn, query, 6)],
+                         [6, 7, 8, 9])
+        self.assertEqual(cache.stats()['stale'], 2)
+
+        # Results can be shared through a backend with get and set
+        # methods, such as a memcache client:
+        class Backend(dict):
+            def set(self, key, value):
+                assert isinstance(key, str) and isinstance(value, str)
+                self[key] = value
+
+        backend = Backend()
+        caches = ResultCache(backend), ResultCache(backend)
+        for cache in caches:
+            self.assertEqual([o.i for o in cache.search(conn, query, 7)],
+                             [7, 8, 9])
+        self.assertEqual([(c.stats()['hits'], c.stats()['misses'])
+                          for c in caches],
+                         [(0, 1), (1, 0)])
+
+    def test_lru_backend(self):
+        from ..search import LRUBackend
+        backend = LRUBackend(max_entries=3, max_bytes=10)
+        for k in 'abc':
+            backend.set(k, k * 3)
+        self.assertEqual(backend.get('a'), 'aaa')
+        backend.set('d', 'ddd') # evicts b, the least recently used
+        self.assertEqual(backend.get('b'), None)
+        backend.set('e', 'eeee') # too many bytes, evicts c
+        self.assertEqual(list(backend.data), ['a', 'd', 'e'])
+        self.assertEqual((backend.size, backend.evictions), (10, 2))
+        backend.set('f', 'f' * 11) # too big to cache
+        self.assertEqual(backend.get('f'), None)
+
+    def test_prepared_statements(self):
+        self.start_updater()
+        for i in range(9):
+            tid = self.store(i, i=i, __acl__=[['Allow', 'bob', ['read']]])
+        self.wait_tid(tid)
+
+        from ..search import Statement, prepared_statements
+        from ..search import search, search_batch
+        from ..aclfilteredsearch import filteredsearch
+        self.ex(check_access)
+        self.ex("create or replace function get_parent_id(state jsonb)"
+                " returns int as 'select null::int' language sql immutable")
+        self.addCleanup(self.ex, "drop function check_access"
+                        "(jsonb, varchar[], varchar), get_parent_id(jsonb)")
+        statement = Statement(filteredsearch(
+            "select zoid, state from object_json"
+            " where (state->>'i')::int >= %(lo)s",
+            None, None, docid='zoid', docs='object_json'))
+        self.assertEqual(statement.names, ['lo', 'principals', 'permission'])
+        query = ("select zoid, class_pickle from object_json"
+                 " where zoid in (%s) order by zoid" % statement.query)
+
+        conn = self.db.open()
+        lo_zoids = sorted(
+            utils.u64(o._p_oid) for o in search(
+                conn, "select zoid, class_pickle from object_json"
+                " where (state->>'i')::int >= 7"))
+        for principal, expected in ('bob', lo_zoids), ('sally', []):
+            args = dict(lo=7, principals=[principal], permission='read')
+            self.assertEqual(
+                sorted(z for [z] in self.execute(conn, statement, args)),
+                expected)
+
+        # Statements can be used with search and search_batch:
+        statement = Statement(query)
+        args = dict(lo=5, principals=['bob'], permission='read')
+        self.assertEqual([o.i for o in search(conn, statement, **args)],
+                         [5, 6, 7, 8])
+        count, batch = search_batch(conn, statement, args, 1, 2)
+        self.assertEqual((count, [o.i for o in batch]), (4, [6, 7]))
+        count, batch = search_batch(conn, statement, args, 1, 2,
+                                    prefetch=True)
+        self.assertEqual((count, [o._p_changed for o in batch]),
+                         (4, [False, False]))
+
+        stats = dict((s['name'], s) for s in prepared_statements(conn))
+        self.assertEqual(stats[statement.name]['statement'],
+                         'prepare %s as %s' % (statement.name, statement.sql))
+        if 'generic_plans' in stats[statement.name]: # Postgres 14
+            s = stats[statement.name]
+            self.assertEqual(s['generic_plans'] + s['custom_plans'], 1)
+
+        with self.assertRaises(ValueError):
+            Statement("select %s, %(x)s")
+
+    def test_columns(self):
+        self.start_updater()
+        for i in range(9):
+            tid = self.store(i, i=i, title='t%s' % i, tags=['a', i])
+        self.wait_tid(tid)
+
+        from ..search import search_columns, search_records, column_chunks
+        query = ("select zoid, state from object_json"
+                 " where (state->>'i')::int >= %s order by zoid")
+        columns = [('title', "state->>'title'"), ('tags', "state->'tags'")]
+
+        conn = self.db.open()
+        zoids = [utils.u64(o._p_oid) for o in self.conn.root().values()]
+        zoids = sorted(zoids)[6:]
+        with mock.patch.object(conn._storage, 'load') as load:
+            data = search_columns(conn, query, (6,), columns)
+            self.assertEqual(data, dict(zoid=zoids,
+                                        title=['t6', 't7', 't8'],
+                                        tags=[['a', 6], ['a', 7], ['a', 8]]))
+
+            records = search_records(conn, query, (7,), dict(columns))
+            self.assertEqual([(r.zoid, r.title, r.tags) for r in records],
+                             [(zoids[1], 't7', ['a', 7]),
+                              (zoids[2], 't8', ['a', 8])])
+
+            with column_chunks(conn, query, (5,), columns[:1], 3) as chunks:
+                self.assertEqual([c['title'] for c in chunks],
+                                 [['t5', 't6', 't7'], ['t8']])
+
+            self.assertEqual(load.call_count, 0)
+        self.assertEqual(len(conn._cache), 0)
+
+    def test_tracing(self):
+        self.start_updater()
+        for i in range(9):
+            tid = self.store(i, i=i)
+        self.wait_tid(tid)
+
+        from .. import tracing
+        from ..search import Statement, search, search_batch, search_iterator
+        events = []
+        tracing.install(tracing.Tracer(slow=0, sample_rate=1,
+                                       sink=events.append))
+        self.addCleanup(tracing.install, None)
+
+        conn = self.db.open()
+        query = ("select zoid, class_pickle from object_json"
+                 " where (state->>'i')::int >= %s order by zoid")
+        search(conn, query, 6)
+        search_batch(conn, query, (7,), 0, 1)
+        with search_iterator(conn, query, (5,)) as it:
+            list(it)
+        search(conn, Statement(query), 8)
+        self.assertEqual(
+            [(e['function'], e['shape'], e['rows'], e['objects'])
+             for e in events],
+            [('search', '(int)', 3, 3),
+             ('search_batch', '(int)', 1, 1),
+             ('search_iterator', '(int)', 4, 4),
+             ('search', '(int)', 1, 1),
+             ])
+        for event in events:
+            self.assertTrue(event['plan'][0]['Plan'])
+        self.assertEqual(events[0]['fingerprint'], events[3]['fingerprint'])
+        self.assertEqual(events[0]['query'],
+                         "select zoid, class_pickle from object_json where"
+                         " (state->>?)::int >= %s order by zoid")
+
+        stats = dict((s['fingerprint'], s)
+                     for s in tracing.tracer.stats())
+        stats = stats[events[0]['fingerprint']]
+        self.assertEqual((stats['count'], stats['rows'], stats['functions']),
+                         (3, 8, ['search', 'search_iterator']))
+
+    def test_search_many(self):
+        self.start_updater()
+        for i in range(9):
+            tid = self.store(i, i=i, title='%' + str(i))
+        self.wait_tid(tid)
+
+        from ..search import search_many
+        query = ("select zoid, class_pickle from object_json"
+                 " where (state->>'i')::int >= %s order by zoid desc")
+        queries = [
+            (query, (6,)),
+            ("select zoid, class_pickle from object_json"
+             " where state->>'title' like %(t)s", dict(t='%%3')),
+            (query, (9,)),
+            (query, (7,)),
+            ]
+        conn = self.db.open()
+        with mock.patch.object(conn._storage, 'ex_cursor',
+                               side_effect=conn._storage.ex_cursor) as ex:
+            results = search_many(conn, queries)
+            self.assertEqual(ex.call_count, 1)
+        self.assertEqual([[o.i for o in r] for r in results],
+                         [[8, 7, 6], [3], [], [8, 7]])
+        self.assertTrue(results[0][1] is results[3][1])
+
+        conn = self.db.open()
+        with mock.patch.object(conn._storage, 'load') as load:
+            results = search_many(conn, queries, prefetch=True)
+            self.assertEqual([[o.i for o in r] for r in results],
+                             [[8, 7, 6], [3], [], [8, 7]])
+            self.assertEqual(load.call_count, 0)
+        self.assertEqual(search_many(conn, []), [])
+
+        # Rows, such as counts, can be returned instead of objects:
+        results = search_many(conn, [
+            (query, (7,)),
+            ("select count(*) from object_json"
+             " where (state->>'i')::int >= %s", (7,), True),
+            ("select state->>'i' as i, state->>'title' as title"
+             " from object_json where state->>'title' like %(t)s",
+             dict(t='%%3'), True),
+            ])
+        self.assertEqual([o.i for o in results[0]], [8, 7])
+        self.assertEqual(results[1:], [[{u'count': 2}],
+                                       [{u'i': u'3', u'title': u'%3'}]])
+
+    def test_replicas(self):
+        self.start_updater()
+        for i in range(3):
+            tid = self.store(i, i=i)
+        self.wait_tid(tid)
+
+        from .. import replicas
+        from ..search import search, prefetch_search
+        query = ("select zoid, class_pickle from object_json"
+                 " where zoid > 0 order by zoid")
+        # The primary stands in for a replica.
+        router = replicas.ReplicaRouter([''], wait=.1, interval=.02)
+        self.assertEqual(replicas.install(router), None)
+        self.addCleanup(router.close)
+        self.addCleanup(replicas.install, None)
+
+        conn = self.db.open()
+        with mock.patch.object(conn._storage, 'ex_cursor') as ex:
+            self.assertEqual([o.i for o in search(conn, query)], [0, 1, 2])
+            self.assertEqual(ex.call_count, 0)
+        self.assertEqual(router.stats(),
+                         dict(replica=1, primary=0, waits=0))
+        self.assertEqual(len(router.idle), 1)
+
+        # Objects created after the connection's last transaction are
+        # left out, and states newer than it aren't prefetched:
+        from ZODB.POSException import POSKeyError
+        from ..search import ResultCache
+        self.wait_tid(self.store(9, i=9))
+        new_oid = self.conn.root()[9]._p_oid
+        oids = [self.conn.root()[i]._p_oid for i in range(3)]
+        seen = mock.patch.object(conn._storage, 'lastTransaction',
+                                 return_value=utils.p64(tid))
+        def snapshot_load(oid):
+            # The connection's snapshot, as of tid:
+            if oid == new_oid:
+                raise POSKeyError(oid)
+        with seen, mock.patch.object(conn._storage, 'load',
+                                     side_effect=snapshot_load) as load:
+            result = prefetch_search(conn, query)
+            self.assertEqual([o._p_changed for o in result],
+                             [False, False, False])
+            self.assertEqual(load.call_count, 1)
+            self.assertEqual([o._p_oid for o in search(conn, query)], oids)
+            self.assertEqual(
+                [o._p_oid for o in ResultCache().search(conn, query)], oids)
+
+        with self.assertRaises(ValueError):
+            replicas.ReplicaRouter([])
+
+        # A lagging replica is waited for, and then the primary is used:
+        lag = mock.patch.object(conn._storage, 'lastTransaction',
+                                return_value=utils.p64(tid << 1))
+        with lag:
+            # The connection's own snapshot doesn't include the new object:
+            self.assertEqual([o.i for o in search(conn, query)], [0, 1, 2])
+        stats = router.stats()
+        self.assertEqual((stats['replica'], stats['primary']), (4, 1))
+        self.assertTrue(stats['waits'] > 0)
+
+        router.fallback = False
+        with lag:
+            with self.assertRaises(replicas.ReplicaLag):
+                search(conn, query)
+
+        # Objects changed since are still found:
+        self.conn.root()[2]._p_changed = True
+        self.conn.transaction_manager.commit()
+        self.wait_tid(utils.u64(self.conn.root()[2]._p_serial))
+        with seen, mock.patch.object(conn._storage, 'load',
+                                     side_effect=snapshot_load) as load:
+            self.assertEqual([o._p_oid for o in search(conn, query)], oids)
+            self.assertEqual(load.call_count, 2) # the new and changed
+
+    def test_replica_connections(self):
+        self.start_updater()
+        tid = self.store(0, i=0)
+        self.wait_tid(tid)
+
+        from .. import replicas
+        from ..search import search
+        query = ("select zoid, class_pickle from object_json"
+                 " where zoid > 0 order by zoid")
+        bad = 'host=/nonexistent'
+        # Replicas are used in turn, starting with the second:
+        router = replicas.ReplicaRouter(['', bad], wait=0)
+        replicas.install(router)
+        self.addCleanup(router.close)
+        self.addCleanup(replicas.install, None)
+        handler = InstalledHandler('j1m.relstoragejsonsearch.replicas')
+        self.addCleanup(handler.uninstall)
+
+        conn = self.db.open()
+        connect = mock.patch.object(replicas, 'Replica',
+                                    side_effect=replicas.Replica)
+        for i in range(4):
+            with connect as Replica:
+                self.assertEqual([o.i for o in search(conn, query)], [0])
+            # Failed connections are retried after a backoff.  Idle
+            # connections that have caught up are used without
+            # connecting to other replicas.
+            self.assertEqual([c[0][0] for c in Replica.call_args_list],
+                             [[bad, ''], [], [bad, ''], []][i])
+            self.assertEqual(router.failures[bad][0], [1, 1, 2, 2][i])
+            if i == 1:
+                router.close()
+                router.failures[bad] = 1, 0 # Time to retry
+
+        self.assertEqual(router.stats()['replica'], 4)
+        self.assertEqual(len(router.idle), 1)
+        self.assertEqual([r.getMessage() for r in handler.records],
+                         ["Connecting to replica 'host=/nonexistent'"] * 2)
+
+    def test_replica_tracing(self):
+        # Slow queries are explained on the replica they ran on.
+        self.start_updater()
+        for i in range(3):
+            tid = self.store(i, i=i)
+        self.wait_tid(tid)
+
+        from .. import replicas, tracing
+        from ..search import Statement, search
+        router = replicas.ReplicaRouter([''])
+        replicas.install(router)
+        self.addCleanup(router.close)
+        self.addCleanup(replicas.install, None)
+        events = []
+        tracing.install(tracing.Tracer(slow=0, sample_rate=1,
+                                       sink=events.append))
+        self.addCleanup(tracing.install, None)
+
+        conn = self.db.open()
+        query = ("select zoid, class_pickle from object_json"
+                 " where (state->>'i')::int >= %s order by zoid")
+        with mock.patch.object(conn._storage, 'ex_cursor') as ex:
+            self.assertEqual([o.i for o in search(conn, query, 1)], [1, 2])
+            # The statement is only prepared on the replica:
+            self.assertEqual([o.i for o in search(conn, Statement(query), 2)],
+                             [2])
+            self.assertEqual(ex.call_count, 0)
+        self.assertEqual([bool(e['plan']) for e in events], [True, True])
+
+        # Prepared statements are reported for replicas too:
+        from ..search import prepared_statements
+        statements = [(s['replica'], s['name'])
+                      for s in prepared_statements(conn)]
+        self.assertTrue(('', Statement(query).name) in statements)
+        self.assertFalse((None, Statement(query).name) in statements)
+
+    @unittest.skipUnless(os.environ.get('RS_JSON_REPLICA_DSN'),
+                         "RS_JSON_REPLICA_DSN isn't set")
+    def test_replica_dsn(self):
+        # Searches are run on the database named by RS_JSON_REPLICA_DSN,
+        # which needn't really be a replica; the object_json tables, and
+        # object_state tids, are copied to it.
+        dsn = os.environ['RS_JSON_REPLICA_DSN']
+        self.start_updater()
+        for i in range(3):
+            tid = self.store(i, i=i)
+        self.wait_tid(tid)
+
+        import psycopg2
+        replica = psycopg2.connect(dsn)
+        self.addCleanup(replica.close)
+        rcursor = replica.cursor()
+        rcursor.execute("drop table if exists"
+                        " object_json, object_json_tid, object_state")
+        rcursor.execute("create table object_json"
+                        " (zoid bigint primary key, class_name text,"
+                        "  class_pickle bytea, state jsonb)")
+        rcursor.execute("create table object_json_tid (tid bigint)")
+        rcursor.execute("create table object_state (zoid bigint, tid bigint)")
+        self.ex("select zoid, tid from object_state")
+        rcursor.executemany("insert into object_state values (%s, %s)",
+                            self.cursor.fetchall())
+        self.ex("select zoid, class_name, class_pickle, state::text"
+                " from object_json where zoid > 0")
+        rcursor.executemany("insert into object_json values (%s, %s, %s, %s)",
+                            self.cursor.fetchall())
+        rcursor.execute("insert into object_json_tid values (%s)", (tid - 1,))
+        replica.commit()
+        def drop():
+            rcursor.execute(
+                "drop table object_json, object_json_tid, object_state")
+            replica.commit()
+        self.addCleanup(drop)
+
+        from .. import replicas
+        from ..search import search
+        # Only the replica has the objects:
+        self.ex("delete from object_json where zoid > 0")
+        query = ("select zoid, class_pickle from object_json"
+                 " where zoid > 0 order by zoid")
+        router = replicas.ReplicaRouter([dsn], wait=.1, interval=.02)
+        replicas.install(router)
+        self.addCleanup(router.close)
+        self.addCleanup(replicas.install, None)
+
+        # The replica is behind:
+        conn = self.db.open()
+        self.assertEqual(search(conn, query), [])
+        stats = router.stats()
+        self.assertEqual((stats['replica'], stats['primary']), (0, 1))
+
+        # It catches up:
+        rcursor.execute("update object_json_tid set tid = %s", (tid,))
+        replica.commit()
+        self.assertEqual([o.i for o in search(conn, query)], [0, 1, 2])
+        stats = router.stats()
+        self.assertEqual((stats['replica'], stats['primary']), (1, 1))
+
+    def execute(self, conn, statement, args):
+        cursor = conn._storage.ex_cursor()
+        statement.execute(cursor, args)
+        return cursor.fetchall()
+
+check_access = """
+create or replace function check_access(
+  state jsonb,
+  principals varchar[],
+  permission varchar)
+  returns bool as $$
+declare
+  acl jsonb;
+  want text[] := array[permission, '*'];
+begin
+  acl := state -> '__acl__';
+  if acl is null then
+    return null;
+  end if;
+
+  for i in 0 .. (jsonb_array_length(acl) - 1)
+  loop
+    if acl -> i ->> 1 = any(principals) and acl -> i -> 2 ?| want then
+       return acl -> i ->> 0 = 'Allow';
+    end if;
+  end loop;
+  return null;
+end
+$$ language plpgsql;
+"""
@@ -0,0 +1,104 @@
+import psycopg2
+import unittest
+from zope.testing.loggingsupport import InstalledHandler
+
+from .. import tracing
+from .testaclfilteredsearch import check_access, get_parent_id
+
+class Tests(unittest.TestCase):
+
+    def tearDown(self):
+        tracing.install(None)
+
+    def test_normalize(self):
+        self.assertEqual(
+            tracing.normalize(
+                "select *\n  from docs where x = 'it''s' and y > 42.5"
+                " and check_access(state, array['bob', 'all'], 'read')"),
+            "select * from docs where x = ? and y > ?"
+            " and check_access(state, array[?], ?)")
+        self.assertEqual(tracing.fingerprint("select 1"),
+                         tracing.fingerprint("select  2"))
+
+    def test_shape(self):
+        self.assertEqual(tracing.shape((1, 'a', [1])), '(int, str, list)')
+        self.assertEqual(tracing.shape(dict(b='x', a=1)), '{a: int, b: str}')
+        self.assertEqual(tracing.shape(None), '()')
+
+    def test_plan_summary(self):
+        plan = [{'Plan': {
+            'Node Type': 'Nested Loop',
+            'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'docs'},
+                {'Node Type': 'Index Scan', 'Relation Name': 'object_json',
+                 'Index Name': 'object_json_pkey'},
+                ]}}]
+        self.assertEqual(tracing.plan_summary(plan),
+                         (['object_json_pkey'], ['docs']))
+
+    def test_filteredsearch_is_traced(self):
+        from ..aclfilteredsearch import filteredsearch
+        events = []
+        tracer = tracing.Tracer(slow=0, sample_rate=1, sink=events.append)
+        self.assertEqual(tracing.install(tracer), None)
+        conn = psycopg2.connect('')
+        try:
+            cursor = conn.cursor()
+            # Functions are created in the transaction, which is
+            # rolled back.
+            cursor.execute(check_access)
+            cursor.execute(get_parent_id)
+            cursor.execute("create temp table docs (docid int, state jsonb)")
+            cursor.execute("""insert into docs values
+                (1, '{"__acl__": [["Allow", "bob", ["read"]]]}')""")
+            self.assertEqual(
+                filteredsearch("select * from docs", 'read', ['bob'],
+                               cursor=cursor),
+                [(1,)])
+        finally:
+            conn.close()
+
+        [event] = events
+        self.assertEqual(
+            (event['function'], event['rows'], event['objects'],
+             event['seq_scans']),
+            ('filteredsearch', 1, 0, ['docs']))
+        [stats] = tracer.stats()
+        self.assertEqual((stats['count'], stats['slow'], stats['functions']),
+                         (1, 1, ['filteredsearch']))
+        self.assertEqual(stats['seq_scans'], ['docs'])
+
+    def test_tracing_errors_are_logged(self):
+        tracer = tracing.Tracer(slow=0, sample_rate=1)
+        tracing.install(tracer)
+        def cursor_factory():
+            raise ValueError
+        handler = InstalledHandler('j1m.relstoragejsonsearch.tracing')
+        try:
+            tracing.record('search', cursor_factory, 'select 1', (), 1, 1, 1)
+        finally:
+            handler.uninstall()
+        self.assertEqual(tracer.stats(), [])
+        [record] = handler.records
+        self.assertEqual(record.getMessage(), 'Tracing search')
+
+    def test_explain_failures_dont_abort_transactions(self):
+        tracing.install(tracing.Tracer(slow=0, sample_rate=1))
+        conn = psycopg2.connect('')
+        try:
+            cursor = conn.cursor()
+            cursor.execute("set local statement_timeout = 50")
+            handler = InstalledHandler('j1m.relstoragejsonsearch.tracing')
+            try:
+                tracing.record('search', conn.cursor, 'select pg_sleep(1)',
+                               (), 1, 1, 1)
+            finally:
+                handler.uninstall()
+            [record] = handler.records
+            self.assertEqual(record.getMessage(), 'Tracing search')
+
+            # The transaction can still be used:
+            cursor.execute("select 42")
+            self.assertEqual(cursor.fetchall(), [(42,)])
+        finally:
+            conn.close()
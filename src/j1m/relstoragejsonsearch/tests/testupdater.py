@@ -1,9 +1,14 @@
 import json
 import mock
+import psycopg2
+import threading
+import time
 import traceback
+from zope.testing.wait import wait
 from zope.testing.loggingsupport import InstalledHandler
 
 from . import pgbase
+from ..updater import ClassTransformations
 
 class Tests(pgbase.PGTestBase):
 
@@ -12,6 +17,119 @@ class Tests(pgbase.PGTestBase):
         self.assertEqual(non_empty_generator(iter(())), None)
         self.assertEqual(list(non_empty_generator(iter((1, 2, 3)))), [1, 2, 3])
 
+    def test_pipeline(self):
+        from ..updater import Pipeline
+        updates = [iter([(1, 1, 'a'), (1, 2, 'b'), (2, 3, 'c')]),
+                   iter([(3, 4, 'd')])]
+        writer = FakeWriter()
+        pipeline = Pipeline(updates, FakeConverter(), writer)
+        pipeline.run()
+        self.assertEqual(writer.calls,
+                         [('write', [(1, 1, 'A'), (1, 2, 'B')]),
+                          ('write', [(2, 3, 'C')]),
+                          ('commit', 2),
+                          ('write', [(3, 4, 'D')]),
+                          ('commit', 3),
+                          ])
+        stats = pipeline.stats()
+        self.assertEqual(sorted(stats), ['read', 'write'])
+        self.assertEqual(stats['read']['depth'], 0)
+        self.assertTrue(stats['write']['max_depth'] >= 1)
+
+    def test_pipeline_stage_failure(self):
+        from ..updater import Pipeline
+        writer = FakeWriter()
+        convert = FakeConverter()
+        convert.fail = True
+        with self.assertRaises(ValueError):
+            Pipeline([iter([(1, 1, 'a')])], convert, writer).run()
+        self.assertEqual(writer.calls, [])
+
+    def test_notifications(self):
+        # Notifications are sent once per statement with the last tid
+        # and the number of records changed.
+        self.setup_object_json()
+        import psycopg2
+        conn = psycopg2.connect(self.conn.dsn)
+        conn.autocommit = True
+        conn.cursor().execute("listen object_state_changed")
+        self.ex("insert into object_state"
+                " select i, 3 + i % 2, '' from generate_series(1, 3) i")
+        self.ex("update object_state set tid = 5")
+        wait(lambda: conn.poll() or len(conn.notifies) == 2, 9)
+        self.assertEqual([n.payload for n in conn.notifies],
+                         ['4 3', '5 3'])
+        conn.close()
+
+    def test_upgrade_replaces_only_per_row_triggers(self):
+        from ..updater import upgrade_object_json
+        self.setup_object_json()
+        triggers_sql = ("select tgname, oid from pg_trigger"
+                        " where tgrelid = 'object_state'::regclass"
+                        " order by tgname")
+        self.ex(triggers_sql)
+        triggers = list(self.cursor)
+        upgrade_object_json(self.cursor)
+        self.ex(triggers_sql)
+        self.assertEqual(list(self.cursor), triggers)
+
+        # An older per-row trigger is replaced:
+        self.ex("drop trigger trigger_notify_object_state_inserted"
+                " on object_state")
+        self.ex("drop trigger trigger_notify_object_state_updated"
+                " on object_state")
+        self.ex("create function notify_per_row() returns trigger as $$"
+                " begin return NEW; end; $$ language plpgsql")
+        self.ex("create trigger trigger_notify_object_state_changed"
+                " after insert or update on object_state for each row"
+                " execute procedure notify_per_row()")
+        upgrade_object_json(self.cursor)
+        self.ex(triggers_sql)
+        self.assertEqual([name for (name, oid) in self.cursor],
+                         ['trigger_notify_object_state_inserted',
+                          'trigger_notify_object_state_updated'])
+        self.ex("drop function notify_per_row()")
+
+    def test_upgrade_adds_missing_pickle_hash(self):
+        from ..updater import upgrade_object_json
+        self.setup_object_json()
+        self.ex("alter table object_json drop column pickle_hash")
+        self.ex("alter table object_json_tid drop column generation")
+        upgrade_object_json(self.cursor)
+        self.ex("select pickle_hash from object_json")
+        self.ex("select generation from object_json_tid")
+        self.assertEqual(list(self.cursor), [(0,)])
+
+        # Once the column exists, upgrading doesn't wait for searches:
+        conn = psycopg2.connect(self.conn.dsn)
+        try:
+            conn.cursor().execute("select * from object_json")
+            self.ex("set lock_timeout = 100")
+            upgrade_object_json(self.cursor)
+        finally:
+            self.ex("reset lock_timeout")
+            conn.close()
+
+    def test_listen_coalesces_notifications(self):
+        self.setup_object_json()
+        from ..updater import Updates, notification_count
+        import psycopg2
+        self.assertEqual(notification_count('42 7'), 7)
+        self.assertEqual(notification_count('42'), 1)
+        updates = Updates(psycopg2.connect(self.conn.dsn), debounce=.5)
+        listen = updates._listen()
+
+        def store():
+            time.sleep(.1)
+            for i in range(3):
+                self.store(i + 1, i)
+
+        thread = threading.Thread(target=store)
+        thread.start()
+        self.assertEqual(next(listen), 3)
+        thread.join()
+        listen.close()
+
     def test_update_iterator(self):
         t = 0
         for i in range(99):
@@ -75,6 +193,145 @@ class Tests(pgbase.PGTestBase):
         self.ex("select zoid from object_json")
         self.assertEqual(list(self.cursor), [(3L,)])
 
+    def test_binary_limit_and_decoders(self):
+        import hashlib
+        import zlib
+        self.start_updater(
+            '--binary-limit', '10',
+            '--decoder', 'j1m.relstoragejsonsearch.tests.testupdater.P='
+            'j1m.relstoragejsonsearch.updater:decode_cached_data')
+        data = zlib.compress(u'cafe\x00'.encode('utf-8'))
+        self.store(1, 1, small='\xff', large=data)
+        self.store_ob(1, 2, P(dict(data=data, encoding='utf-8')))
+        self.store_ob(1, 3, P(dict(data='\xff')))
+        self.wait_tid(1)
+        self.ex("select state from object_json order by zoid")
+        self.assertEqual(
+            [s for [s] in self.cursor],
+            [{u'small': {u'::': u'hex', u'hex': u'ff'},
+              u'large': {u'::': u'bytes', u'length': len(data),
+                         u'md5': hashlib.md5(data).hexdigest()}},
+             {u'text': u'cafe'},
+             {u'text': u''},
+             ])
+
+    def test_projection(self):
+        self.start_updater(
+            '--project', 'j1m.relstoragejsonsearch.tests.testupdater.P='
+            'title, docid')
+        self.store(1, 1, title='a', history=[1, 2])
+        self.store_ob(1, 2, P(dict(title='b', docid=2, history=[1, 2])))
+        self.wait_tid(1)
+        self.ex("select state from object_json order by zoid")
+        self.assertEqual([s for [s] in self.cursor],
+                         [{u'title': u'a', u'history': [1, 2]},
+                          {u'title': u'b', u'docid': 2}])
+
+    def test_skipped_classes_arent_unpickled(self):
+        import BTrees.OOBTree
+        import ZODB.serialize
+        from ..updater import jsonify
+        p = ZODB.serialize.ObjectWriter().serialize(BTrees.OOBTree.BTree())
+        with mock.patch('j1m.relstoragejsonsearch.updater.JsonUnpickler') as u:
+            self.assertEqual(jsonify((1, 1, p, None), None), None)
+            self.assertFalse(u.called)
+
+    def test_jsonify_buffers(self):
+        import persistent.mapping
+        import ZODB.serialize
+        from ..updater import jsonify
+        p = ZODB.serialize.ObjectWriter().serialize(
+            persistent.mapping.PersistentMapping(x=1))
+        expected = jsonify((1, 1, p, None), lambda z, c, s: s)
+        self.assertEqual(expected[2], 'persistent.mapping.PersistentMapping')
+        for d in buffer(p), memoryview(p):
+            self.assertEqual(jsonify((1, 1, d, None), lambda z, c, s: s),
+                             expected)
+
+    def test_skip_and_include_classes(self):
+        import BTrees.OOBTree
+        import persistent.list
+        import persistent.mapping
+        self.start_updater('--include-class', 'persistent[.]',
+                           '--include-class', 'j1m[.]',
+                           '--skip-class', r'persistent\.list')
+        self.store_ob(1, 1, BTrees.OOBTree.BTree())
+        self.store_ob(2, 2, persistent.mapping.PersistentMapping())
+        self.store_ob(3, 3, persistent.list.PersistentList())
+        self.store(4, 4, n=1)
+        self.wait_tid(4)
+        self.ex("select zoid from object_json order by zoid")
+        self.assertEqual(list(self.cursor), [(2,), (4,)])
+
+    def test_skip_unchanged(self):
+        # Records whose pickles haven't changed aren't converted or
+        # rewritten.
+        self.start_updater()
+        self.ex('begin')
+        self.store(1, 1, a=1)
+        self.store(1, 2, a=2)
+        self.ex('commit')
+        self.wait_tid(1)
+        self.ex("select zoid, xmin::text from object_json order by zoid")
+        before = list(self.cursor)
+        self.ex('begin')
+        self.store(2, 1, a=1)
+        self.store(2, 2, a=3)
+        self.ex('commit')
+        self.wait_tid(2)
+        self.ex("select zoid, xmin::text, state->>'a' from object_json"
+                " order by zoid")
+        after = list(self.cursor)
+        self.assertEqual(after[0], before[0] + ('1',))
+        self.assertNotEqual(after[1][1], before[1][1])
+        self.assertEqual(after[1][2], '3')
+
+    def test_skip_unchanged_when_reading_ahead(self):
+        # A record whose pickle matches the stored hash isn't skipped
+        # if an earlier, different, version hasn't been written yet.
+        from ..updater import Converter, Pipeline, Updates, Writer
+        from ..updater import default_transformation
+        self.setup_object_json()
+        self.store(1, 1, a='A')
+        conn = psycopg2.connect(self.conn.dsn)
+        reader_conn = psycopg2.connect(self.conn.dsn)
+        self.addCleanup(conn.close)
+        self.addCleanup(reader_conn.close)
+        convert = Converter(default_transformation)
+        Pipeline(Updates(reader_conn, -1, 1, check_hashes=True),
+                 convert, Writer(conn.cursor())).run()
+        self.assertEqual(self.last_tid(), 1)
+
+        writing = threading.Event()
+        proceed = threading.Event()
+
+        class SlowWriter(Writer):
+            def write(self, data):
+                if not writing.is_set():
+                    writing.set()
+                    proceed.wait(9)
+                Writer.write(self, data)
+
+        updates = Updates(reader_conn, 1, check_hashes=True, poll_timeout=1)
+        thread = threading.Thread(
+            target=Pipeline(updates, convert, SlowWriter(conn.cursor())).run)
+        thread.setDaemon(True)
+        thread.start()
+
+        # Zoid 1 goes from A to B and back to A, while the writer is
+        # still writing B:
+        self.store(2, 1, a='B')
+        writing.wait(9)
+        self.store(3, 1, a='A')
+        wait(lambda: updates.tid == 3, 9)
+        proceed.set()
+
+        self.wait_tid(3)
+        self.ex("notify object_state_changed, 'STOP'")
+        thread.join(9)
+        self.ex("select state->>'a' from object_json where zoid = 1")
+        self.assertEqual(self.cursor.fetchall(), [('A',)])
+
     def test_custom_transformations(self):
         # We can supply a trandformation function that transforms data
         # after it has been converted to json.
@@ -90,6 +347,221 @@ class Tests(pgbase.PGTestBase):
              u'class_name': u'j1m.relstoragejsonsearch.tests.pgbase.O',
              u'zoid': 1})
 
+    def test_batch_transformations(self):
+        # Batch transformations are called with converted chunks and
+        # can dispatch records by class:
+        del batches[:]
+        self.start_updater(
+            '-Xj1m.relstoragejsonsearch.tests.testupdater:batch', '-w2')
+        self.ex('begin')
+        for i in range(6):
+            if i % 2:
+                self.store_ob(1, i, P(dict(a=i)))
+            else:
+                self.store(1, i, a=i)
+        self.ex('commit')
+        self.wait_tid(1)
+        self.ex("select zoid, state from object_json order by zoid")
+        self.assertEqual(
+            list(self.cursor),
+            [(i, {u'a': i, u'n': 3} if i % 2 else {u'a': i})
+             for i in range(6)])
+        self.assertEqual([sorted(b) for b in batches], [[1, 3, 5]])
+
+    def test_workers(self):
+        # Conversion can be spread over worker processes:
+        self.start_updater(
+            '-w2', '-xj1m.relstoragejsonsearch.tests.testupdater:custom')
+        for t in range(1, 26):
+            self.ex('begin')
+            for i in range(t * 10 - 10, t * 10):
+                self.store(t, i, a=i)
+            self.ex('commit')
+        self.wait_tid(25)
+        self.ex("select zoid, state->>'A', state->>'zoid' from object_json"
+                " order by zoid")
+        self.assertEqual(list(self.cursor),
+                         [(i, str(i), str(i)) for i in range(250)])
+
+    def test_rejected_records_are_logged_and_skipped(self):
+        with mock.patch("j1m.relstoragejsonsearch.updater.logger") as logger:
+            self.start_updater(
+                '-xj1m.relstoragejsonsearch.tests.testupdater:reject_odd')
+            self.ex('begin')
+            for i in range(9):
+                self.store(1, i, a=i)
+            self.ex('commit')
+            self.wait_tid(1)
+            self.ex("select zoid from object_json order by zoid")
+            self.assertEqual([z for (z,) in self.cursor], [0, 2, 4, 6, 8])
+            self.assertEqual(
+                sorted(c[1][1:] for c in logger.exception.mock_calls),
+                [(1, 1), (1, 3), (1, 5), (1, 7)])
+
+    def test_backfill(self):
+        for i in range(1, 50):
+            self.store(i, i, a=i)
+        self.store(50, 60, a=60)
+        self.start_updater('--backfill', '3')
+        self.wait_tid(50)
+        self.ex("select zoid, state->>'a' from object_json order by zoid")
+        self.assertEqual(list(self.cursor),
+                         [(i, str(i)) for i in range(1, 50)] + [(60, '60')])
+        from .. import backfill
+        self.assertFalse(backfill.pending(self.cursor))
+
+        # After the backfill, the updater follows changes:
+        self.store(51, 61, a=61)
+        self.wait_tid(51)
+        self.assertEqual(self.search("zoid = 61"), [(61,)])
+
+    def test_backfill_workers(self):
+        # Backfills convert in as many processes as connections, unless
+        # told otherwise:
+        from ..updater import main
+        for args, workers in ((['--backfill', '3'], 3),
+                              (['--backfill', '3', '-w0'], 0),
+                              ([], 0)):
+            with mock.patch('j1m.relstoragejsonsearch.updater._main'):
+                with mock.patch('j1m.relstoragejsonsearch.updater.Converter'
+                                ) as Converter:
+                    main([''] + args)
+            self.assertEqual(Converter.call_args[0][1], workers)
+
+    def test_backfill_resume(self):
+        for i in range(1, 13):
+            self.store(i, i, a=i)
+        self.setup_object_json()
+        from .. import backfill
+        backfill.setup(self.cursor, 4)
+        self.ex("select lo, hi, done, snapshot_tid from object_json_backfill"
+                " order by lo")
+        self.assertEqual(list(self.cursor), [(0, 3, 0, 12),
+                                             (3, 6, 3, 12),
+                                             (6, 9, 6, 12),
+                                             (9, 12, 9, 12),
+                                             ])
+        # Pretend we were interrupted:
+        self.ex("update object_json_backfill set done = hi where lo = 3")
+        self.ex("update object_json_backfill set done = 7 where lo = 6")
+
+        # A record written after the snapshot is left to the updater:
+        self.store(13, 14, a=14)
+
+        # The backfill is resumed without needing to ask for it:
+        self.start_updater()
+        self.wait_tid(13)
+        self.ex("select zoid from object_json order by zoid")
+        self.assertEqual([z for (z,) in self.cursor],
+                         [1, 2, 3, 8, 9, 10, 11, 12, 14])
+
+        # Each range commit invalidated cached searches:
+        self.ex("select generation from object_json_tid")
+        self.assertEqual(list(self.cursor), [(3,)])
+
+    def test_stats_file(self):
+        import os, shutil, tempfile
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'stats')
+        self.start_updater('--stats-file', path, '--stats-interval', '.1')
+        self.store(1, 1, a=1)
+        self.store(2, 2, a=1)
+        self.wait_tid(2)
+
+        def stats():
+            try:
+                with open(path) as f:
+                    return f.read().split('\n')
+            except IOError:
+                return ()
+
+        wait(lambda: 'rs_json_updater_object_json_tid 2' in stats(), 9)
+        text = stats()
+        self.assertTrue('rs_json_updater_records_converted_total 2' in text)
+        self.assertTrue('rs_json_updater_lag_seconds 0.000' in text)
+
+    def test_redo_selected(self):
+        # Records can be reconverted selectively, by class and zoid,
+        # while the updater is running.
+        self.start_updater()
+        for i in range(1, 5):
+            self.store(i, i, a=i)
+        self.store_ob(5, 5, P(dict(a=5)))
+        self.store_ob(6, 6, P(dict(a=6)))
+        self.wait_tid(6)
+
+        from ..updater import main
+        custom = '-xj1m.relstoragejsonsearch.tests.testupdater:custom'
+        main(['', custom, '--redo-class', r'j1m.+[.]testupdater[.]P$'])
+        main(['', custom, '--redo-zoids', '2-3', '--redo-class',
+              r'j1m\.relstoragejsonsearch\.tests\.pgbase'])
+        # Like --skip-class patterns, patterns match at the start:
+        main(['', custom, '--redo-class', 'pgbase'])
+        self.ex("select zoid, state->>'A' from object_json order by zoid")
+        self.assertEqual(list(self.cursor), [(1, None), (2, '2'), (3, '3'),
+                                             (4, None), (5, '5'), (6, '6')])
+        self.ex("select tid, generation from object_json_tid")
+        self.assertEqual(list(self.cursor), [(6, 2)])
+
+    def test_redo_doesnt_overwrite_newer_data(self):
+        self.store(1, 1, a=1)
+        self.store(1, 2, a=2)
+        self.setup_object_json()
+        from ..updater import Converter
+        from ..redo import RedoWriter
+        conn = psycopg2.connect('')
+        self.addCleanup(conn.close)
+        convert = Converter(custom)
+        self.ex("select tid, zoid, state, null from object_state")
+        data = convert(list(self.cursor))
+        self.ex("insert into object_json (zoid, class_name, state)"
+                " values (1, 'O', '{}'), (2, 'O', '{}')")
+
+        # Record 2 changed after it was read:
+        self.store(2, 2, a=3)
+
+        writer = RedoWriter(conn.cursor())
+        writer.write(data)
+        writer.commit(None)
+        self.ex("select zoid, state from object_json order by zoid")
+        self.assertEqual(
+            list(self.cursor),
+            [(1, {u'A': 1,
+                  u'class_name': u'j1m.relstoragejsonsearch.tests.pgbase.O',
+                  u'zoid': 1}),
+             (2, {})])
+
+    def test_gc(self):
+        # Objects removed by packing are removed from object_json by
+        # running the updater with the gc option.
+        self.start_updater()
+        for i in range(1, 11):
+            self.store(i, i, a=i)
+        self.wait_tid(10)
+        self.stop_updater()
+
+        self.ex("delete from object_state where zoid in (2, 3, 4, 7, 10)")
+        from .. import garbage
+        handler = InstalledHandler('j1m.relstoragejsonsearch.garbage')
+        self.addCleanup(handler.uninstall)
+        from ..updater import main
+        main(['', '--gc', '--gc-batch-size', '3'])
+        self.ex("select zoid from object_json order by zoid")
+        self.assertEqual([z for (z,) in self.cursor], [1, 5, 6, 8, 9])
+        self.assertEqual(str(handler),
+                         'j1m.relstoragejsonsearch.garbage INFO\n'
+                         '  Deleted 5 orphaned object_json records')
+
+        # Generations are incremented for batches with deletions:
+        self.ex("select generation from object_json_tid")
+        self.assertEqual(list(self.cursor), [(4,)])
+
+        # Nothing is left to collect:
+        self.assertEqual(garbage.collect(self.conn), 0)
+        self.ex("select generation from object_json_tid")
+        self.assertEqual(list(self.cursor), [(4,)])
+
     def test_redo(self):
         # If you change a transformation, you'll want to redo the
         # updates you made before.  If you use the redo option, then
@@ -113,6 +585,30 @@ class Tests(pgbase.PGTestBase):
                u'zoid': 1},),
              ({u'a': 2},)])
 
+class P(pgbase.O):
+    pass
+
+class FakeConverter:
+
+    chunk_size = 2
+    fail = False
+
+    def __call__(self, data):
+        if self.fail:
+            raise ValueError(data)
+        return [(tid, zoid, state.upper()) for (tid, zoid, state) in data]
+
+class FakeWriter:
+
+    def __init__(self):
+        self.calls = []
+
+    def write(self, data):
+        self.calls.append(('write', data))
+
+    def commit(self, tid):
+        self.calls.append(('commit', tid))
+
 def custom(zoid, class_name, state):
     state = json.loads(state)
     state = {
@@ -123,6 +619,20 @@ def custom(zoid, class_name, state):
     state['zoid'] = zoid
     return state
 
+batches = []
+batch = ClassTransformations()
+
+@batch.register('j1m.relstoragejsonsearch.tests.testupdater.P')
+def batch_p(records):
+    batches.append([zoid for (zoid, class_name, state) in records])
+    return [dict(json.loads(state), n=len(records))
+            for (zoid, class_name, state) in records]
+
+def reject_odd(zoid, class_name, state):
+    if zoid % 2:
+        return '{"a": "\\u0000"}' # Postgres can't store nulls in text
+    return state
+
 def pr(fmt, *args):
     print(fmt % args)
     traceback.print_exc()
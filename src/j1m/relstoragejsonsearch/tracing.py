@@ -0,0 +1,180 @@
+"""Search tracing
+
+When a Tracer is installed, searches are timed and their
+statistics collected by SQL fingerprint: the query text with literals
+and whitespace normalized.  Plans of slow queries are captured with
+``EXPLAIN (ANALYZE, BUFFERS)`` on a sampled basis, showing which
+indexes were used and which tables were scanned sequentially.
+
+Tracing is off by default and costs nothing but a time call per
+search when off.
+"""
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+tracer = None
+
+def install(new):
+    """Install a tracer, or uninstall the current one, if None is passed
+
+    The previously installed tracer, if any, is returned.
+    """
+    global tracer
+    old = tracer
+    tracer = new
+    return old
+
+def record(function, cursor_factory, query, args, seconds, rows, objects):
+    """Record a search with the installed tracer, if there is one
+    """
+    if tracer is not None:
+        try:
+            tracer.record(function, cursor_factory, query, args,
+                          seconds, rows, objects)
+        except Exception:
+            logger.exception("Tracing %s", function)
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_arrays = re.compile(r"array\[[?,\s]*\]", re.I)
+
+def normalize(query):
+    """Return query text with literals and whitespace normalized
+    """
+    query = _literals.sub('?', query)
+    query = _arrays.sub('array[?]', query)
+    return ' '.join(query.split())
+
+def fingerprint(query):
+    return hashlib.sha1(normalize(query)).hexdigest()[:16]
+
+def shape(args):
+    """Describe the types of query arguments, without their values
+    """
+    if isinstance(args, dict):
+        return '{%s}' % ', '.join('%s: %s' % (k, type(v).__name__)
+                                   for (k, v) in sorted(args.items()))
+    return '(%s)' % ', '.join(type(v).__name__ for v in args or ())
+
+def plan_summary(plan):
+    """Return the indexes used and the tables scanned sequentially by a plan
+
+    The plan is the output of ``EXPLAIN (FORMAT JSON)``.
+    """
+    indexes = set()
+    seq_scans = set()
+
+    def visit(node):
+        if 'Index Name' in node:
+            indexes.add(node['Index Name'])
+        if node.get('Node Type') == 'Seq Scan':
+            seq_scans.add(node.get('Relation Name'))
+        for child in node.get('Plans', ()):
+            visit(child)
+
+    for item in plan:
+        visit(item['Plan'])
+    return sorted(indexes), sorted(seq_scans)
+
+class Tracer:
+    """Collect search statistics and capture slow-query plans
+
+    Searches taking at least slow seconds are explained with a
+    probability of sample_rate.  Explaining re-executes the query.
+
+    If a sink is given, it's called with a dictionary describing each
+    traced search: its function, fingerprint, normalized query,
+    argument shape, time, row and object counts, and, if captured, its
+    plan, indexes and sequentially scanned tables.
+    """
+
+    def __init__(self, slow=1.0, sample_rate=.1, sink=None):
+        self.slow = slow
+        self.sample_rate = sample_rate
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.queries = {}
+
+    def record(self, function, cursor_factory, query, args,
+               seconds, rows, objects):
+        text = getattr(query, 'query', query) # Statements have query text
+        event = dict(
+            function=function,
+            fingerprint=fingerprint(text),
+            query=normalize(text),
+            shape=shape(args),
+            seconds=seconds,
+            rows=rows,
+            objects=objects,
+            )
+        slow = seconds >= self.slow
+        if slow and random.random() < self.sample_rate:
+            event['plan'] = plan = self.explain(cursor_factory, query, args)
+            event['indexes'], event['seq_scans'] = plan_summary(plan)
+
+        with self.lock:
+            stats = self.queries.get(event['fingerprint'])
+            if stats is None:
+                stats = self.queries[event['fingerprint']] = dict(
+                    fingerprint=event['fingerprint'], query=event['query'],
+                    functions=set(), count=0, seconds=0.0, max_seconds=0.0,
+                    rows=0, objects=0, slow=0, plan=None)
+            stats['functions'].add(function)
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['rows'] += rows
+            stats['objects'] += objects
+            stats['slow'] += slow
+            if 'plan' in event:
+                for name in 'plan', 'indexes', 'seq_scans':
+                    stats[name] = event[name]
+
+        if self.sink is not None:
+            self.sink(event)
+
+    def explain(self, cursor_factory, query, args):
+        if isinstance(query, basestring):
+            sql = query
+        else:
+            # A Statement, which is explained by executing it by name.
+            sql, args = query.execute_sql(args)
+        cursor = cursor_factory()
+        # Explaining runs in the caller's transaction, which a failure,
+        # such as a statement timeout, mustn't abort.
+        savepoint = not cursor.connection.autocommit
+        try:
+            if savepoint:
+                cursor.execute("savepoint rsjs_explain")
+            try:
+                cursor.execute(
+                    "explain (analyze, buffers, format json) " + sql, args)
+                [[plan]] = cursor.fetchall()
+            except Exception:
+                if savepoint:
+                    cursor.execute("rollback to savepoint rsjs_explain")
+                raise
+            if savepoint:
+                cursor.execute("release savepoint rsjs_explain")
+        finally:
+            cursor.close()
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return plan
+
+    def stats(self):
+        """Return query statistics, slowest total time first
+        """
+        with self.lock:
+            stats = [dict(s, functions=sorted(s['functions']))
+                     for s in self.queries.values()]
+        return sorted(stats, key=lambda s: s['seconds'], reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.queries.clear()
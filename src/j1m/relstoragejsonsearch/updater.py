@@ -5,17 +5,27 @@ from __future__ import print_function
 import argparse
 import binascii
 import contextlib
+import hashlib
 import itertools
 import json
 import logging
+import multiprocessing
 import psycopg2
 import Queue
 import re
 import select
+import struct
+import sys
+import threading
+import time
 from cStringIO import StringIO
 import zlib
 
-from .jsonpickle import JsonUnpickler
+from .jsonpickle import JsonEmitter, JsonUnpickler, Unsupported
+from .jsonpickle import class_name as sniff_class_name
+from .metrics import Metrics
+from . import backfill
+from . import garbage
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +41,16 @@ parser.add_argument('-t', '--poll-timeout', type=int, default=30,
                     help='Change-poll timeout, in seconds')
 parser.add_argument('-m', '--transaction-size-limit', type=int, default=100000,
                     help='Transaction size limit (aproximate)')
+parser.add_argument('-d', '--debounce', type=float, default=0,
+                    help='Time, in seconds, to wait for additional change'
+                    ' notifications before processing changes')
+parser.add_argument('-w', '--workers', type=int,
+                    help='Number of conversion worker processes'
+                    ' (0 converts in the updater process).  Defaults to'
+                    ' the --backfill concurrency, if given, or 0')
+parser.add_argument('-q', '--queue-size', type=int, default=4,
+                    help='Number of chunks that may be queued between'
+                    ' the read, convert and write stages')
 parser.add_argument(
     '-l', '--logging-configuration', default='info',
     help='Logging configuration file path, or a logging level name')
@@ -44,6 +64,62 @@ A function that is called with zoid, class_name, and state and returns
 a new state.
 ''')
 
+parser.add_argument(
+    '-X', '--batch-transformation', type=global_object,
+    help='''\
+Batch state-transformation function (module:expr)
+
+A function that is called with a list of (zoid, class_name, state)
+tuples for each converted chunk and returns a list of new states, in
+the same order.  It's called after the -x transformation, in the
+updater process.  ClassTransformations objects can be used to
+dispatch records to batch functions registered for their classes.
+''')
+
+parser.add_argument(
+    '--skip-class', action='append', metavar='PATTERN',
+    help="""\
+Skip records whose class names start with a match of a regular expression
+
+This option may be repeated. If not given, BTrees and blobs are skipped.
+""")
+parser.add_argument(
+    '--include-class', action='append', metavar='PATTERN',
+    help="""\
+Only convert records whose class names start with a match of a
+regular expression
+
+This option may be repeated.
+""")
+
+parser.add_argument(
+    '--binary-limit', type=int, metavar='BYTES',
+    help="""\
+Size, in bytes, above which binary data are replaced by descriptors
+
+Binary (non-ascii) strings are normally stored as hex.  Larger strings
+are replaced by objects with their lengths and MD5 digests.
+""")
+parser.add_argument(
+    '--decoder', action='append', metavar='CLASS=module:expr',
+    help="""\
+Decoder for the states of a class
+
+A function that's called with the state of an instance of the class,
+as plain Python data, and returns data to be stored instead, for
+example text extracted from compressed binary data.  This option may
+be repeated.
+""")
+
+parser.add_argument(
+    '--project', action='append', metavar='CLASS=NAME[,NAME...]',
+    help="""\
+Only convert the named top-level attributes of instances of a class
+
+Other attributes are left out of object_json, saving conversion time
+and storage and index space.  This option may be repeated.
+""")
+
 parser.add_argument(
     '--redo', action='store_true',
     help="""\
@@ -58,56 +134,325 @@ transformations. It should be run *after* restarting the regulsr
 updater.
 """)
 
-insert_sql = """
-insert into object_json (zoid, class_name, class_pickle, state)
-values %s
+parser.add_argument(
+    '--redo-class', action='append', metavar='PATTERN',
+    help="""\
+Reconvert records whose class names start with a match of a regular
+expression and exit
+
+Only matching records are read from object_state, and this can be run
+while the regular updater is running.  This option may be repeated.
+""")
+parser.add_argument(
+    '--redo-zoids', action='append', metavar='ZOID[-ZOID]',
+    help="""\
+Reconvert records with zoids in an inclusive range and exit
+
+This option may be repeated and may be combined with --redo-class.
+""")
+
+parser.add_argument('--metrics-port', type=int,
+                    help='Port to serve Prometheus-style metrics on')
+parser.add_argument('--stats-file',
+                    help='Path of a file to periodically write metrics to')
+parser.add_argument('--stats-interval', type=float, default=60,
+                    help='Interval, in seconds, between lag measurements'
+                    ' and stats-file updates')
+
+parser.add_argument(
+    '--backfill', type=int, metavar='CONCURRENCY',
+    help="""\
+Populate object_json by converting zoid ranges concurrently
+
+Records written through the current last tid are converted using
+CONCURRENCY connections.  Progress is saved as ranges are converted, so
+an interrupted backfill is resumed when the updater is restarted.
+When the backfill is complete, the updater follows changes made after
+the backfill started.
+
+Unless --workers is given, CONCURRENCY worker processes are used, as
+conversion in the updater process is limited to one CPU.
+""")
+
+parser.add_argument(
+    '--gc', action='store_true',
+    help="""Delete object_json records for objects that have been packed away and exit
+
+Records are checked and deleted in zoid ranges, committing after each
+range, so this can be run after each pack without disrupting searches.
+""")
+parser.add_argument('--gc-batch-size', type=int, default=10000,
+                    help='Number of zoids to check in each gc transaction')
+parser.add_argument('--gc-pause', type=float, default=0,
+                    help='Seconds to pause between gc transactions')
+
+staging_sql = """
+create temp table if not exists object_json_staging (
+  tid bigint, zoid bigint, class_name text, class_pickle bytea, state text,
+  pickle_hash bigint)
+"""
+
+merge_sql = """
+insert into object_json (zoid, class_name, class_pickle, state, pickle_hash)
+select zoid, class_name, class_pickle, state::jsonb, pickle_hash
+from object_json_staging
 on conflict (zoid)
 do update set class_name   = excluded.class_name,
               class_pickle = excluded.class_pickle,
-              state        = excluded.state
+              state        = excluded.state,
+              pickle_hash  = excluded.pickle_hash
 """
 
-skip_class = re.compile('BTrees[.]|ZODB.blob').match
+default_skip_classes = ('BTrees[.]', 'ZODB.blob')
+
+def class_filter(skip=default_skip_classes, include=()):
+    """Return a function that tests whether a class should be skipped
+
+    Patterns are regular expressions matched against the starts of
+    class names.  Classes matching skip patterns are skipped.  If
+    include patterns are given, classes that don't match any of them
+    are skipped too.
+    """
+    skip = re.compile('|'.join(skip)).match if skip else None
+    include = re.compile('|'.join(include)).match if include else None
+
+    def skip_class(class_name):
+        return bool((skip is not None and skip(class_name)) or
+                    (include is not None and not include(class_name)))
+
+    return skip_class
+
+skip_class = class_filter()
 
 def bytea_hex(bytes):
     return b'\\x' + binascii.b2a_hex(bytes)
 
-def jsonify(item, xform):
-    tid, zoid, p = item
-    p = p[:] # Convert read buffer to bytes
+def pickle_hash(p):
+    """Compute a compact (64-bit) hash of a database record
+    """
+    return struct.unpack('>q', hashlib.md5(p).digest()[:8])[0]
 
+def parse_decoder(spec):
+    """Parse a CLASS=module:expr decoder specification
+    """
+    class_name, _, name = spec.partition('=')
+    return class_name, global_object(name)
 
-    f = StringIO(p)
-    unpickler = JsonUnpickler(f)
-    klass = unpickler.load()
-    klass = json.loads(klass)
-    if isinstance(klass, list):
-        klass, args = klass
+def parse_projection(spec):
+    """Parse a CLASS=NAME[,NAME...] projection specification
+    """
+    class_name, _, names = spec.partition('=')
+    return class_name, frozenset(name.strip() for name in names.split(','))
+
+def decode_cached_data(state):
+    """Extract the text from Karl's compressed _CachedData states
+    """
+    try:
+        text = zlib.decompress(state['data'])
+        text = text.decode(state.get('encoding') or 'ascii')
+    except (KeyError, TypeError, zlib.error, LookupError, UnicodeDecodeError):
+        text = u''
+    return dict(text=text.replace(u'\x00', u''))
+
+def scrub_surrogates(state):
+    # Remove unicode surrogate strings, as postgres utf-8
+    # will reject them.
+    return unicode_surrogates.sub(' ', state)
+
+def jsonify(item, xform, note=None, skip=skip_class,
+            binary_limit=None, decoders={}, projections={}):
+    """Convert a (tid, zoid, state, pickle_hash) record
+
+    A (tid, zoid, class_name, class_pickle, json_state, pickle_hash)
+    tuple is returned, or None if the record is unchanged or of a
+    class for which skip returns true.  If a note function is given,
+    it's called with a status, class name, zoid and conversion time.
+
+    Binary data longer than binary_limit are replaced by descriptors.
+    decoders maps class names to functions that are called with
+    unpickled states and return data to be converted instead.
+    States that JsonEmitter can't load can't be decoded, and are
+    logged and noted as 'undecoded'.  projections maps class
+    names to collections of the top-level attributes to convert.
+    Projections are applied before decoders.
+    """
+    start = time.time()
+    tid, zoid, p, old_hash = item # p may be a read buffer
+
+    phash = pickle_hash(p)
+    if phash == old_hash:
+        if note is not None:
+            note('unchanged', None, zoid, time.time() - start)
+        return None
+
+    # Check the class before unpickling, as most records are
+    # typically of skipped classes.
+    class_name = sniff_class_name(p)
+    if class_name is not None and skip(class_name):
+        if note is not None:
+            note('skipped', class_name, zoid, time.time() - start)
+        return None
+
+    if class_name is None:
+        unpickler = JsonUnpickler(p, binary_limit)
+        klass = unpickler.load()
+        klass = json.loads(klass)
         if isinstance(klass, list):
-            class_name = '.'.join(klass)
+            klass, args = klass
+            if isinstance(klass, list):
+                class_name = '.'.join(klass)
+            else:
+                class_name = klass['name']
         else:
             class_name = klass['name']
-    else:
-        class_name = klass['name']
 
-    if skip_class(class_name):
-        return None
+        if skip(class_name):
+            if note is not None:
+                note('skipped', class_name, zoid, time.time() - start)
+            return None
+
+    decode = decoders.get(class_name)
+    f = StringIO(p)
+    emitter = JsonEmitter(f, binary_limit)
+    try:
+        emitter.skip()
+        class_pickle_length = f.tell()
+        state = emitter.load(decode, projections.get(class_name))
+    except Unsupported:
+        # Probably cyclic, or unsupported by zodbpickle. Start over, as
+        # the state may refer to objects memoized in the class pickle.
+        state = None
+        unpickler = JsonUnpickler(p, binary_limit)
+        unpickler.skip()
+        class_pickle_length = unpickler.tell()
+        unpickler.attributes = projections.get(class_name)
+        if decode is not None:
+            logger.warning("Couldn't decode %s record %s", class_name, zoid)
+            if note is not None:
+                note('undecoded', class_name, zoid, 0)
 
-    class_pickle_length = f.tell()
     class_pickle = bytea_hex(p[:class_pickle_length])
 
-    state = unpickler.load()
+    # The emitter removes surrogates itself.
+    scrub = state is None
+    if scrub:
+        state = unpickler.load()
+        if unpickler._x_cyclic and note is not None:
+            note('cyclic', class_name, zoid, 0)
     xstate = xform(zoid, class_name, state)
     if xstate is not state:
+        scrub = True
         state = xstate
         if not isinstance(state, bytes):
             state = json.dumps(state)
 
-    # Remove unicode surrogate strings, as postgres utf-8
-    # will reject them.
-    state = unicode_surrogates.sub(' ', state)
+    if scrub:
+        state = scrub_surrogates(state)
 
-    return tid, zoid, class_name, class_pickle, state
+    if note is not None:
+        note('converted', class_name, zoid, time.time() - start)
+
+    return tid, zoid, class_name, class_pickle, state, phash
+
+_worker_xform = _worker_skip = None
+_worker_options = {}
+
+def _init_worker(xform, skip, include, options):
+    global _worker_xform, _worker_skip, _worker_options
+    _worker_xform = xform
+    _worker_skip = class_filter(skip, include)
+    _worker_options = options
+
+def _worker_jsonify(item):
+    notes = []
+    result = jsonify(item, _worker_xform, lambda *args: notes.append(args),
+                     _worker_skip, **_worker_options)
+    return result, notes
+
+class Converter:
+    """Convert (tid, zoid, state) records to json
+
+    If workers is greater than 0, conversion is done in a pool of
+    worker processes.  Results are always returned in the order of the
+    input records, so the tid of the last record in a chunk is safe to
+    record as the last tid processed.
+
+    Records are skipped based on skip and include class-name patterns,
+    as described for class_filter.  binary_limit, decoders and
+    projections are passed to jsonify.  When workers are used,
+    decoders must be picklable, typically module-level functions.
+    """
+
+    pool = None
+
+    def __init__(self, xform, workers=0, metrics=None,
+                 skip=default_skip_classes, include=(),
+                 binary_limit=None, decoders=None, projections=None,
+                 batch_xform=None):
+        self.xform = xform
+        self.batch_xform = batch_xform
+        self.workers = workers
+        self.metrics = metrics or Metrics()
+        self.skip = class_filter(skip, include)
+        self.options = options = dict(
+            binary_limit=binary_limit,
+            decoders=dict(decoders or ()),
+            projections=dict(projections or ()),
+            )
+        if workers > 0:
+            self.pool = multiprocessing.Pool(
+                workers, _init_worker, (xform, skip, include, options))
+
+    @property
+    def chunk_size(self):
+        return 100 * max(self.workers, 1)
+
+    def __call__(self, data):
+        note = self.metrics.note_conversion
+        if self.pool is None:
+            xform = self.xform
+            skip = self.skip
+            options = self.options
+            results = [jsonify(d, xform, note, skip, **options) for d in data]
+        else:
+            # Convert read buffers to bytes, so they can be sent to workers.
+            results = self.pool.map(
+                _worker_jsonify,
+                [(tid, zoid, bytes(state), phash)
+                 for (tid, zoid, state, phash) in data])
+            for result, notes in results:
+                for args in notes:
+                    note(*args)
+            results = [result for (result, notes) in results]
+
+        if self.batch_xform is not None:
+            results = self._transform(results)
+        return results
+
+    def _transform(self, results):
+        converted = [r for r in results if r]
+        if not converted:
+            return results
+        states = iter(self.batch_xform(
+            [(zoid, class_name, state)
+             for (tid, zoid, class_name, class_pickle, state, phash)
+             in converted]))
+        transformed = []
+        for r in results:
+            if r:
+                state = next(states)
+                if state is not r[4]:
+                    if not isinstance(state, bytes):
+                        state = json.dumps(state)
+                    r = r[:4] + (scrub_surrogates(state),) + r[5:]
+            transformed.append(r)
+        return transformed
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 def non_empty_generator(gen):
     try:
@@ -120,10 +465,45 @@ def non_empty_generator(gen):
             yield v
     return it()
 
+updates_sql = """
+select tid, zoid, state, null::bigint from object_state
+where tid > %s and tid <= %s order by tid
+"""
+
+# Also get the hashes of the records we've already converted, so
+# unchanged records can be skipped.
+updates_with_hashes_sql = """
+select s.tid, s.zoid, s.state, j.pickle_hash
+from object_state s left join object_json j using (zoid)
+where s.tid > %s and s.tid <= %s order by s.tid
+"""
+
+def notification_count(payload):
+    """Get the number of changed records from a notification payload
+    """
+    payload = payload.split()
+    if len(payload) == 2:
+        return int(payload[1])
+    else:
+        return 1 # A notification from an older, per-row, trigger
+
 class Updates:
+    """Iterate over batches of (tid, zoid, state, pickle_hash) records
+
+    If check_hashes is true, the pickle hashes stored in object_json
+    are included, so unchanged records can be skipped.  Updates are
+    read ahead of writes, so a stored hash may be for an earlier
+    version of a record than one that's been read but not committed.
+    Hashes are left out (None) for records read after an uncommitted
+    version of the same object.  committed should be called with each
+    tid committed.
+    """
+
+    max_iterator_size = 10000
 
     def __init__(self, conn, start_tid=-1, end_tid=None,
-                 limit=100000, poll_timeout=30, iterator_size=100):
+                 limit=100000, poll_timeout=30, iterator_size=100,
+                 check_hashes=False, debounce=0):
         self.conn = conn
         self.cursor = conn.cursor()
         self.ex = self.cursor.execute
@@ -133,18 +513,37 @@ class Updates:
         self.poll_timeout = poll_timeout
         self.limit = limit
         self.iterator_size = iterator_size
+        self.check_hashes = check_hashes
+        self.sql = updates_with_hashes_sql if check_hashes else updates_sql
+        self.debounce = debounce
+        self.committed_tid = start_tid
+        self.pending = {} # {zoid -> tid} of records read
+
+    def committed(self, tid):
+        self.committed_tid = tid
 
-    def _batch(self):
+    def _batch(self, expected=None):
         tid = self.tid
+        # Get the committed tid before our snapshot is taken, so
+        # the hashes we read include writes through it.
+        committed = self.committed_tid
+        pending = self.pending = dict(
+            (zoid, t) for (zoid, t) in self.pending.iteritems()
+            if t > committed)
+        check_hashes = self.check_hashes
         self.ex('begin')
         try:
             updates = self.conn.cursor('object_state_updates')
-            updates.itersize = self.iterator_size
+            if expected:
+                # We know about how many records to expect, so try
+                # to fetch them in one go.
+                updates.itersize = max(
+                    min(expected, self.limit, self.max_iterator_size),
+                    self.iterator_size)
+            else:
+                updates.itersize = self.iterator_size
             try:
-                updates.execute("""\
-                select tid, zoid, state from object_state
-                where tid > %s and tid <= %s order by tid
-                """, (tid, self.end_tid))
+                updates.execute(self.sql, (tid, self.end_tid))
             except Exception:
                 logger.exception("Getting updates after %s", tid)
                 self.ex('rollback')
@@ -156,6 +555,11 @@ class Updates:
                     if n >= self.limit:
                         break
                     tid = self.tid = row[0]
+                if check_hashes:
+                    zoid = row[1]
+                    if pending.get(zoid, committed) > committed:
+                        row = row[:3] + (None,)
+                    pending[zoid] = tid
                 yield row
                 n += 1
         finally:
@@ -163,6 +567,7 @@ class Updates:
                 updates.close()
             except Exception:
                 pass
+            self.conn.rollback()
 
     def _listen(self):
         conn = psycopg2.connect(self.conn.dsn)
@@ -176,13 +581,25 @@ class Updates:
             while True:
                 if select.select([conn], (), (), timeout) == ([], [], []):
                     yield None
-                else:
+                    continue
+
+                # Coalesce notifications that arrive within the
+                # debounce window, yielding the number of changed records.
+                count = 0
+                deadline = time.time() + self.debounce
+                while True:
                     conn.poll()
-                    if conn.notifies:
-                        if any(n.payload == 'STOP' for n in conn.notifies):
+                    for notify in conn.notifies:
+                        if notify.payload == 'STOP':
                             return # for tests
-                        # yield the last
-                        yield conn.notifies[-1].payload
+                        count += notification_count(notify.payload)
+                    del conn.notifies[:]
+                    wait = deadline - time.time()
+                    if (wait <= 0 or
+                        select.select([conn], (), (), wait) == ([], [], [])):
+                        break
+                if count:
+                    yield count
         finally:
             conn.close()
 
@@ -196,61 +613,285 @@ class Updates:
                 yield batch
 
         if self.follow:
-            for payload in self._listen():
-                batch = non_empty_generator(self._batch())
+            for count in self._listen():
+                batch = non_empty_generator(self._batch(count))
                 if batch is not None:
                     yield batch
 
-def update_object_json(batch, ex, mogrify, xform):
-    tid = None
-    while True:
-        data = list(itertools.islice(batch, 0, 100))
-        if not data:
-            break
-        tid = data[-1][0]
+def copy_escape(s):
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return (s.replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r')
+            )
 
-        # Convert, filtering out null conversions (uninteresting classes)
-        data = [j for j in (jsonify(d, xform) for d in data) if j]
-        if not data: # all of the data was uninteresting
-            continue # but wait, there's more
+class Writer:
+    """Write converted records to object_json
 
-        # First, try a bulk insert, which is faster.
+    Records are streamed to a temporary staging table using COPY and
+    then merged into object_json with a single upsert.  If the merge
+    fails, the records are split and retried so that only the rejected
+    records are logged and skipped.
+    """
+
+    merge_sql = merge_sql
+
+    def __init__(self, cursor, metrics=None):
+        self.cursor = cursor
+        self.metrics = metrics or Metrics()
+        self.ex = ex = cursor.execute
+        ex(staging_sql)
+        cursor.connection.commit()
+
+    def write(self, data):
+        # A record may be updated more than once in a chunk. Keep the last.
+        data = sorted(dict((d[1], d) for d in data).values(),
+                      key=lambda d: d[1])
+        self._write(data)
+
+    def _write(self, data):
+        ex = self.ex
+        ex("savepoint s")
         try:
-            ex("savepoint s")
-            ex(insert_sql %
-               ', '.join(
-                   [updates.mogrify('(%s, %s, %s, %s)', d[1:])
-                    for d in data])
-               )
+            self.cursor.copy_expert(
+                "copy object_json_staging from stdin",
+                StringIO(''.join(
+                    '%s\t%s\t%s\t%s\t%s\t%s\n' % (
+                        tid, zoid, copy_escape(class_name),
+                        copy_escape(class_pickle), copy_escape(state), phash)
+                    for (tid, zoid, class_name, class_pickle, state, phash)
+                    in data
+                    )))
+            ex(self.merge_sql)
+            ex("truncate object_json_staging")
             ex('release savepoint s')
         except Exception:
-            # Dang, fall back to individual insert so we can log
-            # individual errors:
             ex("rollback to savepoint s")
-            for d in data:
+            self.metrics.incr('merge_failures')
+            if len(data) > 1:
+                # Split the data to find the record(s) that failed.
+                mid = len(data) // 2
+                self._write(data[:mid])
+                self._write(data[mid:])
+            else:
+                logger.exception("Failed tid=%s, zoid=%s", *data[0][:2])
+                self.metrics.note_failure(data[0][1])
+        else:
+            self.metrics.incr('records_written', len(data))
+
+    def commit(self, tid):
+        if tid is not None:
+            self.ex('update object_json_tid set tid=%s', (tid,))
+        self.cursor.connection.commit()
+        self.metrics.incr('commits')
+
+class StageQueue(Queue.Queue):
+    """Bounded queue between pipeline stages
+
+    Depth statistics are kept to show which stage is the bottleneck.
+    A queue that's usually full has a slow consumer and a queue that's
+    usually empty has a slow producer.
+    """
+
+    closed = False
+
+    def __init__(self, name, maxsize):
+        Queue.Queue.__init__(self, maxsize)
+        self.name = name
+        self.puts = self.depth_total = self.max_depth = 0
+        self.put_wait = self.get_wait = 0.0
+
+    def put(self, item):
+        start = time.time()
+        while True:
+            if self.closed:
+                raise PipelineClosed
+            try:
+                Queue.Queue.put(self, item, True, 1)
+            except Queue.Full:
+                pass
+            else:
+                break
+        self.put_wait += time.time() - start
+        depth = self.qsize()
+        self.puts += 1
+        self.depth_total += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def get(self):
+        start = time.time()
+        while True:
+            if self.closed:
+                raise PipelineClosed
+            try:
+                item = Queue.Queue.get(self, True, 1)
+            except Queue.Empty:
+                pass
+            else:
+                break
+        self.get_wait += time.time() - start
+        return item
+
+    def stats(self):
+        return dict(
+            depth=self.qsize(),
+            mean_depth=float(self.depth_total) / (self.puts or 1),
+            max_depth=self.max_depth,
+            put_wait=self.put_wait,
+            get_wait=self.get_wait,
+            )
+
+class PipelineClosed(Exception):
+    """A pipeline stage was stopped because another stage stopped
+    """
+
+class StageFailed(object):
+    """Queue item used to pass a stage's exception to the writer
+    """
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        t, v, tb = self.exc_info
+        raise t, v, tb
+
+class Pipeline:
+    """Read, convert and write updates in separate stages
+
+    The reader and the converter run in their own threads, and the
+    writer runs in the calling thread. The reader and writer use
+    separate database connections, so reading, conversion and writing
+    overlap.  Stages are connected by bounded queues, so a slow stage
+    applies back pressure to the stages before it.
+
+    Data are committed only at batch (and thus tid) boundaries.
+    """
+
+    def __init__(self, updates, convert, writer, queue_size=4, metrics=None):
+        self.updates = updates
+        self.convert = convert
+        self.writer = writer
+        self.metrics = metrics or Metrics()
+        self.metrics.pipeline = self
+        self.committed = getattr(updates, 'committed', None)
+        self.read_queue = StageQueue('read', queue_size)
+        self.write_queue = StageQueue('write', queue_size)
+
+    def stats(self):
+        return dict((q.name, q.stats())
+                    for q in (self.read_queue, self.write_queue))
+
+    def _stage(self, name, func, output):
+        def run():
+            try:
+                func()
+            except PipelineClosed:
+                pass
+            except Exception:
                 try:
-                    ex("savepoint s")
-                    ex(insert_sql % mogrify('(%s, %s, %s, %s)', d[1:]))
-                    ex('release savepoint s')
-                except Exception:
-                    ex("rollback to savepoint s")
-                    logger.exception("Failed tid=%s, zoid=%s",
-                                     *d[:2])
+                    output.put(StageFailed(sys.exc_info()))
+                except PipelineClosed:
+                    pass
+        thread = threading.Thread(target=run, name=name)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
 
+    def _read(self):
+        chunk_size = self.convert.chunk_size
+        put = self.read_queue.put
+        for batch in self.updates:
+            tid = None
+            while True:
+                data = list(itertools.islice(batch, 0, chunk_size))
+                if not data:
+                    break
+                tid = data[-1][0]
+                self.metrics.incr('records_read', len(data))
+                put((tid, data))
+            put((tid, None)) # end of batch
+        put(None)
 
-    if tid is not None:
-        ex('update object_json_tid set tid=%s', (tid,))
-    ex('commit')
+    def _convert(self):
+        get = self.read_queue.get
+        put = self.write_queue.put
+        convert = self.convert
+        while True:
+            item = get()
+            if isinstance(item, tuple):
+                tid, data = item
+                if data is not None:
+                    # Filter out null conversions (uninteresting classes)
+                    data = [j for j in convert(data) if j]
+                    if not data:
+                        continue
+                    item = tid, data
+            put(item)
+            if not isinstance(item, tuple):
+                break # done or failed
+
+    def run(self):
+        self._stage('read', self._read, self.read_queue)
+        self._stage('convert', self._convert, self.write_queue)
+        get = self.write_queue.get
+        writer = self.writer
+        try:
+            while True:
+                item = get()
+                if item is None:
+                    break
+                if isinstance(item, StageFailed):
+                    item.reraise()
+                tid, data = item
+                if data is None:
+                    writer.commit(tid)
+                    if self.committed is not None:
+                        self.committed(tid)
+                    logger.debug("Committed %s %s", tid, self.stats())
+                else:
+                    writer.write(data)
+        finally:
+            self.read_queue.closed = self.write_queue.closed = True
 
 
 logging_levels = 'DEBUG INFO WARNING ERROR CRITICAL'.split()
 
-def setup_object_json(cursor):
+def _execute_sql_file(cursor, name):
     import os
+    with open(os.path.join(os.path.dirname(__file__), name)) as f:
+        cursor.execute(f.read())
+
+def setup_object_json(cursor):
+    _execute_sql_file(cursor, 'object_json.sql')
+    _execute_sql_file(cursor, 'object_state_notify.sql')
+    cursor.execute('commit')
+
+def _add_missing_column(cursor, table, column, definition):
+    # Altering a table locks it exclusively, blocking searches, even
+    # if the column exists.
+    cursor.execute("select from information_schema.columns"
+                   " where table_schema = 'public' and table_name = %s"
+                   " and column_name = %s", (table, column))
+    if not list(cursor):
+        cursor.execute("alter table %s add column %s %s" % (
+            table, column, definition))
+
+def upgrade_object_json(cursor):
     ex = cursor.execute
-    with open(os.path.join(os.path.dirname(__file__), 'object_json.sql')) as f:
-        ex(f.read())
-        ex('commit')
+    _add_missing_column(cursor, 'object_json', 'pickle_hash', 'bigint')
+    _add_missing_column(cursor, 'object_json_tid', 'generation',
+                        'bigint not null default 0')
+    # Replacing triggers locks object_state exclusively, blocking
+    # RelStorage, so only replace the old per-row trigger.
+    ex("select from pg_trigger"
+       " where tgrelid = 'object_state'::regclass"
+       " and tgname = 'trigger_notify_object_state_changed'")
+    if list(cursor):
+        _execute_sql_file(cursor, 'object_state_notify.sql')
+    ex('commit')
 
 def main(args=None):
     options = parser.parse_args(args)
@@ -266,38 +907,138 @@ def main(args=None):
     if xform is None:
         xform = default_transformation
 
+    metrics = Metrics()
+    server = None
+    if options.metrics_port:
+        from .metrics import serve
+        server = serve(metrics, options.metrics_port)
+
+    # Start workers before connecting, so they don't inherit the connection.
+    skip = options.skip_class
+    if skip is None:
+        skip = default_skip_classes
+    workers = options.workers
+    if workers is None:
+        workers = options.backfill or 0
+    convert = Converter(xform, workers, metrics,
+                        skip, options.include_class or (),
+                        options.binary_limit,
+                        [parse_decoder(d) for d in options.decoder or ()],
+                        [parse_projection(p) for p in options.project or ()],
+                        options.batch_transformation)
+    try:
+        _main(options, convert)
+    finally:
+        convert.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
 
+def _main(options, convert):
     conn = psycopg2.connect(options.url)
+    reader_conn = psycopg2.connect(options.url)
+    try:
+        _run(options, convert, conn, reader_conn)
+    finally:
+        reader_conn.close()
+        conn.close()
+
+def _run(options, convert, conn, reader_conn):
     cursor = conn.cursor()
     ex = cursor.execute
-    mogrify = cursor.mogrify
 
     ex("select from information_schema.tables"
        " where table_schema = 'public' AND table_name = 'object_json'")
     if not list(cursor):
         setup_object_json(cursor)
+    else:
+        upgrade_object_json(cursor)
 
-    ex("select tid from object_json_tid")
-    [[tid]] = cursor.fetchall()
+    if options.gc:
+        garbage.collect(conn, options.gc_batch_size, options.gc_pause)
+        return
 
-    if options.redo:
-        start_tid = -1
-        end_tid = tid
-        logger.info("Redoing through", tid)
-    else:
-        logger.info("Starting updater at %s", tid)
-        start_tid = tid
-        end_tid = None
+    if options.redo_class or options.redo_zoids:
+        from . import redo
+        redo.redo(conn, reader_conn, convert, options.redo_class or (),
+                  [redo.parse_zoids(z) for z in options.redo_zoids or ()])
+        return
+
+    metrics = convert.metrics
+    from .metrics import monitor
+    stop_monitor = monitor(
+        metrics, options.url, options.stats_interval, options.stats_file)
+    try:
+        if options.backfill or backfill.pending(cursor):
+            backfill.backfill(
+                options.url, convert, options.backfill or 1, cursor)
 
-    for batch in Updates(conn, start_tid, end_tid,
-                         limit=options.transaction_size_limit,
-                         poll_timeout=options.poll_timeout,
-                         ):
-        update_object_json(batch, ex, mogrify, xform)
+        ex("select tid from object_json_tid")
+        [[tid]] = cursor.fetchall()
+        writer = Writer(cursor, metrics)
+
+        if options.redo:
+            start_tid = -1
+            end_tid = tid
+            logger.info("Redoing through %s", tid)
+        else:
+            logger.info("Starting updater at %s", tid)
+            start_tid = tid
+            end_tid = None
+
+        updates = Updates(reader_conn, start_tid, end_tid,
+                          limit=options.transaction_size_limit,
+                          poll_timeout=options.poll_timeout,
+                          # When redoing, we want to reconvert everything.
+                          check_hashes=not options.redo,
+                          debounce=options.debounce,
+                          )
+        Pipeline(updates, convert, writer, options.queue_size, metrics).run()
+    finally:
+        stop_monitor.set()
 
 def default_transformation(zoid, class_name, state):
     return state
 
+class ClassTransformations:
+    """Batch transformation that dispatches records by class
+
+    Batch functions are registered for class names.  They're called
+    with lists of (zoid, class_name, state) tuples for their classes
+    and return lists of new states.  The states of records of other
+    classes are unchanged.
+
+    Functions can be registered using decorators::
+
+        transformations = ClassTransformations()
+
+        @transformations.register('karl.models.profile.Profile')
+        def profiles(records):
+            ...
+    """
+
+    def __init__(self, registry=()):
+        self.registry = dict(registry)
+
+    def register(self, class_name, func=None):
+        if func is None:
+            return lambda func: self.register(class_name, func)
+        self.registry[class_name] = func
+        return func
+
+    def __call__(self, records):
+        by_class = {}
+        for i, record in enumerate(records):
+            if record[1] in self.registry:
+                by_class.setdefault(record[1], []).append(i)
+
+        states = [state for (zoid, class_name, state) in records]
+        for class_name, indexes in by_class.items():
+            new = self.registry[class_name]([records[i] for i in indexes])
+            for i, state in zip(indexes, new):
+                states[i] = state
+        return states
+
 
 if __name__ == '__main__':
     main()
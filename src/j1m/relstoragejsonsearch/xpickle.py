@@ -1,29 +1,113 @@
-from pickle import Unpickler
+from pickle import Unpickler, decode_long, _Stop
 from pickle import \
      PERSID, NONE, INT, BININT, BININT1, BININT2, LONG, FLOAT, \
      BINFLOAT, STRING, BINSTRING, SHORT_BINSTRING, UNICODE, \
      BINUNICODE, TUPLE, EMPTY_TUPLE, EMPTY_LIST, EMPTY_DICT, LIST, \
      DICT, INST, OBJ, GLOBAL, REDUCE, GET, BINGET, LONG_BINGET, PUT, \
      BINPUT, LONG_BINPUT, STOP, MARK, BUILD, SETITEMS, SETITEM, \
-     BINPERSID, APPEND, APPENDS, NEWTRUE, NEWFALSE
-from struct import unpack
-
-def load_int(s):
-    return unpack("<i", s)[0]
+     BINPERSID, APPEND, APPENDS, NEWTRUE, NEWFALSE, \
+     PROTO, NEWOBJ, LONG1, LONG4, TUPLE1, TUPLE2, TUPLE3
+from struct import unpack_from
+
+# Protocol 3 and 4 opcodes, which the pickle module doesn't define
+BINBYTES = 'B'
+SHORT_BINBYTES = 'C'
+SHORT_BINUNICODE = '\x8c'
+BINUNICODE8 = '\x8d'
+BINBYTES8 = '\x8e'
+EMPTY_SET = '\x8f'
+ADDITEMS = '\x90'
+FROZENSET = '\x91'
+NEWOBJ_EX = '\x92'
+STACK_GLOBAL = '\x93'
+MEMOIZE = '\x94'
+FRAME = '\x95'
+
+HIGHEST_PROTOCOL = 4
 
 class XUnpickler(Unpickler):
-
-    def __init__(self, *args, **kw):
+    """Unpickle data, calling hooks to create objects
+
+    Pickles are read from a string, buffer or memoryview, or from a
+    file, which is read in full.  Data are read by offset, so strings
+    are sliced out of the pickle data without intermediate copies.
+    """
+
+    def __init__(self, data):
+        if hasattr(data, 'read'):
+            data = data.read()
+        self.__data = data
+        self.__pos = 0
+        self.__size = len(data)
+        self.__memoryview = isinstance(data, memoryview)
         self.__put_objects = {}
-        Unpickler.__init__(self, *args, **kw)
+        self.__set_items = {} # {id(set on stack) -> items}
+        self.memo = {}
+
+    def tell(self):
+        """Return the current position in the pickle data
+        """
+        return self.__pos
+
+    def read(self, n):
+        pos = self.__pos
+        self.__pos = end = pos + n
+        data = self.__data[pos:end]
+        return data.tobytes() if self.__memoryview else data
+
+    def readline(self):
+        pos = self.__pos
+        size = 64
+        while True:
+            chunk = self.read(size)
+            i = chunk.find('\n')
+            if i >= 0:
+                chunk = chunk[:i + 1]
+                break
+            if pos + size >= self.__size:
+                break
+            self.__pos = pos
+            size *= 4
+        self.__pos = pos + len(chunk)
+        return chunk
+
+    def __unpack(self, format, size):
+        pos = self.__pos
+        self.__pos = pos + size
+        return unpack_from(format, self.__data, pos)[0]
+
+    def __load(self):
+        # Like Unpickler.load, but reading opcodes by offset
+        self.mark = object()
+        self.stack = []
+        self.append = self.stack.append
+        data = self.__data
+        dispatch = self.dispatch
+        try:
+            while 1:
+                pos = self.__pos
+                self.__pos = pos + 1
+                dispatch[data[pos]](self)
+        except _Stop, stopinst:
+            return stopinst.value
+        except IndexError:
+            if self.__pos > self.__size:
+                raise EOFError
+            raise
 
     def load(self):
-        return self._x_load(Unpickler.load(self))
+        return self._x_load(self.__load())
+
+    def skip(self):
+        """Read past a pickle without converting it
+        """
+        self.__load()
 
     # Some default noop
     _x_None = lambda self: None
     _x_String = _x_Unicode = _x_Bool = _x_Int = _x_Float = lambda self, v: v
     _x_Dictionary = _x_List = _x_Tuple = _x_Long = _x_String
+    _x_Bytes = lambda self, v: self._x_String(v)
 
     dispatch = {}
     dispatch.update(Unpickler.dispatch)
@@ -50,20 +134,25 @@ class XUnpickler(Unpickler):
 
     def load_int(self):
         s = self.readline()[:-1]
-        i = int(s)
-        self.append(self._x_Int(i))
+        # Protocols 0 and 1 represent booleans as 00 and 01.
+        if s == '00':
+            self.append(self._x_Bool(False))
+        elif s == '01':
+            self.append(self._x_Bool(True))
+        else:
+            self.append(self._x_Int(int(s)))
     dispatch[INT] = load_int
 
     def load_binint(self):
-        self.append(self._x_Int(load_int(self.read(4))))
+        self.append(self._x_Int(self.__unpack('<i', 4)))
     dispatch[BININT] = load_binint
 
     def load_binint1(self):
-        self.append(self._x_Int(load_int(self.read(1) + '\000\000\000')))
+        self.append(self._x_Int(self.__unpack('<B', 1)))
     dispatch[BININT1] = load_binint1
 
     def load_binint2(self):
-        self.append(self._x_Int(load_int(self.read(2) + '\000\000')))
+        self.append(self._x_Int(self.__unpack('<H', 2)))
     dispatch[BININT2] = load_binint2
 
     def load_long(self):
@@ -75,7 +164,7 @@ class XUnpickler(Unpickler):
     dispatch[FLOAT] = load_float
 
     def load_binfloat(self):
-        self.append(self._x_Float(unpack('>d', self.read(8))[0]))
+        self.append(self._x_Float(self.__unpack('>d', 8)))
     dispatch[BINFLOAT] = load_binfloat
 
     def load_string(self):
@@ -85,12 +174,12 @@ class XUnpickler(Unpickler):
     dispatch[STRING] = load_string
 
     def load_binstring(self):
-        len = load_int(self.read(4))
+        len = self.__unpack('<i', 4)
         self.append(self._x_String(self.read(len)))
     dispatch[BINSTRING] = load_binstring
 
     def load_short_binstring(self):
-        len = load_int(self.read(1) + '\000\000\000')
+        len = self.__unpack('<B', 1)
         self.append(self._x_String(self.read(len)))
     dispatch[SHORT_BINSTRING] = load_short_binstring
 
@@ -101,15 +190,72 @@ class XUnpickler(Unpickler):
     dispatch[UNICODE] = load_unicode
 
     def load_binunicode(self):
-        len = load_int(self.read(4))
+        len = self.__unpack('<i', 4)
         self.append(self._x_Unicode(unicode(self.read(len),'utf-8')))
     dispatch[BINUNICODE] = load_binunicode
 
+    def load_short_binunicode(self):
+        len = self.__unpack('<B', 1)
+        self.append(self._x_Unicode(unicode(self.read(len),'utf-8')))
+    dispatch[SHORT_BINUNICODE] = load_short_binunicode
+
+    def load_binunicode8(self):
+        len = self.__unpack('<Q', 8)
+        self.append(self._x_Unicode(unicode(self.read(len),'utf-8')))
+    dispatch[BINUNICODE8] = load_binunicode8
+
+    def load_binbytes(self):
+        len = self.__unpack('<i', 4)
+        self.append(self._x_Bytes(self.read(len)))
+    dispatch[BINBYTES] = load_binbytes
+
+    def load_short_binbytes(self):
+        len = self.__unpack('<B', 1)
+        self.append(self._x_Bytes(self.read(len)))
+    dispatch[SHORT_BINBYTES] = load_short_binbytes
+
+    def load_binbytes8(self):
+        len = self.__unpack('<Q', 8)
+        self.append(self._x_Bytes(self.read(len)))
+    dispatch[BINBYTES8] = load_binbytes8
+
+    def load_long1(self):
+        n = self.__unpack('<B', 1)
+        self.append(self._x_Long(decode_long(self.read(n))))
+    dispatch[LONG1] = load_long1
+
+    def load_long4(self):
+        n = self.__unpack('<i', 4)
+        self.append(self._x_Long(decode_long(self.read(n))))
+    dispatch[LONG4] = load_long4
+
+    def load_proto(self):
+        proto = self.__unpack('<B', 1)
+        if proto > HIGHEST_PROTOCOL:
+            raise ValueError("unsupported pickle protocol: %d" % proto)
+    dispatch[PROTO] = load_proto
+
+    def load_frame(self):
+        self.__pos += 8 # Frames are just a hint for buffering
+    dispatch[FRAME] = load_frame
+
     def load_tuple(self):
         k = self.marker()
         self.stack[k:] = [self._x_Tuple(self.stack[k+1:])]
     dispatch[TUPLE] = load_tuple
 
+    def load_tuple1(self):
+        self.stack[-1:] = [self._x_Tuple((self.stack[-1],))]
+    dispatch[TUPLE1] = load_tuple1
+
+    def load_tuple2(self):
+        self.stack[-2:] = [self._x_Tuple(tuple(self.stack[-2:]))]
+    dispatch[TUPLE2] = load_tuple2
+
+    def load_tuple3(self):
+        self.stack[-3:] = [self._x_Tuple(tuple(self.stack[-3:]))]
+    dispatch[TUPLE3] = load_tuple3
+
     def load_empty_tuple(self):
         self.stack.append(self._x_Tuple(()))
     dispatch[EMPTY_TUPLE] = load_empty_tuple
@@ -122,6 +268,31 @@ class XUnpickler(Unpickler):
         self.stack.append(self._x_Dictionary({}))
     dispatch[EMPTY_DICT] = load_empty_dictionary
 
+    # Sets are represented as their classes called with lists of
+    # items, as they're reduced by protocols before 4.
+    def __set(self, name, items):
+        items = self._x_List(items)
+        ob = self._x_Instance(self._x_Global('__builtin__', name),
+                              self._x_Tuple((items,)))
+        return ob, items
+
+    def load_empty_set(self):
+        ob, items = self.__set('set', [])
+        self.__set_items[id(ob)] = items
+        self.append(ob)
+    dispatch[EMPTY_SET] = load_empty_set
+
+    def load_additems(self):
+        k = self.marker()
+        self.__set_items[id(self.stack[k - 1])].extend(self.stack[k+1:])
+        del self.stack[k:]
+    dispatch[ADDITEMS] = load_additems
+
+    def load_frozenset(self):
+        k = self.marker()
+        self.stack[k:] = [self.__set('frozenset', self.stack[k+1:])[0]]
+    dispatch[FROZENSET] = load_frozenset
+
     def load_list(self):
         k = self.marker()
         self.stack[k:] = [self._x_List(self.stack[k+1:])]
@@ -165,6 +336,13 @@ class XUnpickler(Unpickler):
         self.append(self._x_Global(module, name))
     dispatch[GLOBAL] = load_global
 
+    def load_stack_global(self):
+        stack = self.stack
+        module, name = stack[-2:]
+        del stack[-2:]
+        self.append(self._x_Global(module, name))
+    dispatch[STACK_GLOBAL] = load_stack_global
+
     def load_reduce(self):
         stack = self.stack
 
@@ -176,13 +354,31 @@ class XUnpickler(Unpickler):
         self.append(value)
     dispatch[REDUCE] = load_reduce
 
+    def load_newobj(self):
+        stack = self.stack
+        klass, args = stack[-2:]
+        del stack[-2:]
+        self.append(self._x_Instance(klass, args))
+    dispatch[NEWOBJ] = load_newobj
+
+    def load_newobj_ex(self):
+        # Keyword arguments are passed as a final positional argument.
+        stack = self.stack
+        klass, args, kw = stack[-3:]
+        del stack[-3:]
+        self.append(self._x_Instance(klass, self._x_Tuple(args + (kw,))))
+    dispatch[NEWOBJ_EX] = load_newobj_ex
+
     def __get(self, i):
         self.append(self._x_Get(i, self.__put_objects[i]))
 
     def __put(self, i):
-        ob = self._x_Put(i, self.stack[-1])
+        v = self.stack[-1]
+        ob = self._x_Put(i, v)
         self.stack[-1] = ob
         self.__put_objects[i] = ob
+        if id(v) in self.__set_items:
+            self.__set_items[id(ob)] = self.__set_items[id(v)]
 
     def load_get(self):
         i = self.readline()[:-1]
@@ -190,12 +386,12 @@ class XUnpickler(Unpickler):
     dispatch[GET] = load_get
 
     def load_binget(self):
-        i = load_int(self.read(1) + '\000\000\000')
+        i = self.__unpack('<B', 1)
         self.__get(`i`)
     dispatch[BINGET] = load_binget
 
     def load_long_binget(self):
-        i = load_int(self.read(4))
+        i = self.__unpack('<i', 4)
         self.__get(`i`)
     dispatch[LONG_BINGET] = load_long_binget
 
@@ -205,11 +401,15 @@ class XUnpickler(Unpickler):
     dispatch[PUT] = load_put
 
     def load_binput(self):
-        i = load_int(self.read(1) + '\000\000\000')
+        i = self.__unpack('<B', 1)
         self.__put(`i`)
     dispatch[BINPUT] = load_binput
 
     def load_long_binput(self):
-        i = load_int(self.read(4))
+        i = self.__unpack('<i', 4)
         self.__put(`i`)
     dispatch[LONG_BINPUT] = load_long_binput
+
+    def load_memoize(self):
+        self.__put(`len(self.__put_objects)`)
+    dispatch[MEMOIZE] = load_memoize